@@ -0,0 +1,30 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+__author__ = 'jakub.zygmunt'
+
+@contextmanager
+def atomic_open(filename, mode='w'):
+    """
+    file object writing to a temporary file next to filename, renamed over filename
+    when the block finishes, so readers never see a half-written file
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(dir=folder, prefix='.%s.' % os.path.basename(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        if os.path.exists(filename):
+            os.chmod(tmp_name, os.stat(filename).st_mode & 0777)
+        else:
+            os.chmod(tmp_name, 0644)
+        os.rename(tmp_name, filename)
+    except:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+def atomic_write(filename, content):
+    with atomic_open(filename) as f:
+        f.write(content)
@@ -0,0 +1,81 @@
+import os
+import re
+from atomic_file import atomic_write
+
+__author__ = 'jakub.zygmunt'
+
+class AuthorizeConf(object):
+    """
+    authorize.conf loaded once and split into sections indexed by name,
+    sections which are not changed are written back byte for byte
+    """
+    section_re = re.compile(r'^\[([^\]]+)\]\s*$')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.preamble = ''
+        self.sections = []
+        self.index = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        content = ''
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                content = f.read()
+
+        current = None
+        for line in content.splitlines(True):
+            match = self.section_re.match(line)
+            if match:
+                current = [match.group(1), line]
+                self.index.setdefault(current[0], len(self.sections))
+                self.sections.append(current)
+            elif current is None:
+                self.preamble += line
+            else:
+                current[1] += line
+
+    def hasRole(self, name):
+        return name in self.index
+
+    def clientRoles(self):
+        return [name for name in self.index if name.startswith('role_client-')]
+
+    def setRole(self, name, text, replace=False):
+        """
+        adds section name with text, an existing section is only overwritten when replace is set
+        returns True if the file content changed
+        """
+        if not text.endswith('\n'):
+            text += '\n'
+
+        if name in self.index:
+            section = self.sections[self.index[name]]
+            body = section[1].rstrip('\n')
+            if not replace or body + '\n' == text:
+                return False
+            section[1] = text + section[1][len(body) + 1:]
+        else:
+            last = self.sections[-1] if self.sections else None
+            if last is not None:
+                if not last[1].endswith('\n'):
+                    last[1] += '\n'
+                if not last[1].endswith('\n\n'):
+                    last[1] += '\n'
+            elif self.preamble and not self.preamble.endswith('\n'):
+                self.preamble += '\n'
+            self.index[name] = len(self.sections)
+            self.sections.append([name, text])
+
+        self.changed = True
+        return True
+
+    def render(self):
+        return self.preamble + ''.join(text for name, text in self.sections)
+
+    def save(self):
+        if self.changed:
+            atomic_write(self.filename, self.render())
+            self.changed = False
@@ -0,0 +1,225 @@
+'''
+Benchmarks of the deploy pipeline against a local CMDB stub and synthetic customers
+
+    python benchmark.py --accounts 1,10,100,1000,10000 --output results.jsonl
+    python benchmark.py --latency 0.02 --error-rate 0.01 --compare results.jsonl
+
+every result is a json line labelled with the git revision, so runs of different versions
+can be compared with --compare
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append('test_files')
+
+from cirrus_cmdb import CirrusCmdb, RetryPolicy, CircuitBreaker
+from cmdb_stub import CmdbStub, synthetic_collections
+from deploysplunk import DeploySplunk
+from timing import tracer
+
+__author__ = 'jakub.zygmunt'
+
+
+def git_label():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def measure(func, repeat):
+    """
+    runs func repeat times, returns best and mean seconds and the last result
+    """
+    timings = []
+    result = None
+    for i in range(repeat):
+        started = time.time()
+        result = func()
+        timings.append(time.time() - started)
+    return min(timings), sum(timings) / len(timings), result
+
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.label = args.label or git_label()
+        self.results = []
+        self.folder = tempfile.mkdtemp(prefix='deploysplunk-bench-')
+        self.github_url = None
+
+    def close(self):
+        shutil.rmtree(self.folder)
+
+    def startStub(self, collections):
+        return CmdbStub(collections, per_page=self.args.per_page, latency=self.args.latency,
+            error_rate=self.args.error_rate, timeout_rate=self.args.timeout_rate,
+            timeout_delay=self.args.timeout * 2).start()
+
+    def getCmdb(self, stub, **kwargs):
+        return CirrusCmdb(stub.url, 'a', 'b', timeout=self.args.timeout,
+            retry_policy=RetryPolicy(base_delay=0.01, max_delay=0.5, max_elapsed=60),
+            circuit_breaker=CircuitBreaker(failure_threshold=1000), **kwargs)
+
+    def add(self, name, size, func, **extra):
+        best, mean, result = measure(func, self.args.repeat)
+        record = { 'label': self.label, 'name': name, 'size': size, 'best': best, 'mean': mean }
+        record.update(extra)
+        self.results.append(record)
+        print '%-32s %8s %10.4fs %10.4fs' % (name, size, best, mean)
+        return result
+
+    def cmdbBenchmarks(self, accounts):
+        stub = self.startStub(synthetic_collections(customers=1, accounts=accounts,
+            instances=self.args.instances, security_groups=self.args.security_groups, rules=self.args.rules))
+        try:
+            for workers in sorted(set([1, self.args.page_workers])):
+                cmdb = self.getCmdb(stub, page_workers=workers)
+                suffix = '' if workers == 1 else '[%s workers]' % workers
+                self.add('cmdb.accounts' + suffix, accounts, lambda: cmdb.get_all_aws_account_numbers('Customer 1'))
+                self.add('cmdb.instances' + suffix, self.args.instances,
+                    lambda: cmdb.get_instance_all_by_aws_account_number('%012d' % 1))
+                self.add('cmdb.rules' + suffix, self.args.security_groups,
+                    lambda: cmdb.get_all_security_group_rules_by_aws_account_number('%012d' % 1))
+                cmdb.close()
+        finally:
+            stub.stop()
+
+    def templateBenchmarks(self, accounts):
+        app_folder = os.path.join(self.folder, 'templates-%s' % accounts)
+        shutil.copytree('test_files', app_folder)
+        data = { 'client': 'benchmark',
+                 'aws_accounts': [ { 'number': '%012d' % a } for a in range(accounts) ] }
+        ds = DeploySplunk(out=StringIO())
+        self.add('templates.convert', accounts, lambda: ds.convertAllTemplates(app_folder, data))
+        self.add('templates.incremental', accounts, lambda: ds.convertAllTemplates(app_folder, data, incremental=True))
+
+        conf_file = os.path.join(self.folder, 'authorize-%s.conf' % accounts)
+        clients = [ { 'client': 'client%s' % c } for c in range(accounts) ]
+        def addRoles():
+            shutil.copyfile('test_files/authorize.no-role.generator', conf_file)
+            ds.addUserRoles(conf_file, clients)
+        self.add('authorize.roles', accounts, addRoles)
+
+    def createSkeleton(self):
+        if self.github_url is not None:
+            return self.github_url
+        repo = os.path.join(self.folder, 'skeleton')
+        shutil.copytree('test_files', repo)
+        for cmd in [ ['git', 'init', '-q'], ['git', 'add', '.'],
+                     ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m', 'app'] ]:
+            subprocess.check_call(cmd, cwd=repo)
+        self.github_url = 'file://' + repo
+        return self.github_url
+
+    def deployBenchmark(self, clients):
+        stub = self.startStub(synthetic_collections(customers=clients, accounts=self.args.accounts_per_client,
+            instances=0, security_groups=0))
+        github_url = self.createSkeleton()
+        run = [0]
+        def deploy():
+            run[0] += 1
+            app_home = os.path.join(self.folder, 'apps-%s-%s' % (clients, run[0])) + '/'
+            os.makedirs(app_home)
+            config = { 'base_url': stub.url, 'user': 'a', 'password': 'b', 'app_home': app_home,
+                       'github_url': github_url, 'mirror_dir': os.path.join(self.folder, 'mirror.git'),
+                       'authorize_conf': os.path.join(app_home, 'authorize.conf'),
+                       'page_workers': str(self.args.page_workers) }
+            ds = DeploySplunk(config=config, out=StringIO(), user='user', password='user')
+            ds.splunk_bin = 'test_files/test_splunk.sh'
+            try:
+                return ds.deployMany(workers=self.args.deploy_workers)
+            finally:
+                ds.close()
+        try:
+            results = self.add('deploy.batch', clients, deploy)
+            failed = [r for r in results.values() if r['status'] != 'ok']
+            if failed:
+                print '  %s clients failed, first: %s' % (len(failed), failed[0]['output'] or failed[0]['error'])
+        finally:
+            stub.stop()
+
+    def run(self):
+        print '%-32s %8s %11s %11s' % ('benchmark', 'size', 'best', 'mean')
+        if self.args.stages:
+            tracer.start()
+        for accounts in self.args.accounts:
+            self.cmdbBenchmarks(accounts)
+            self.templateBenchmarks(accounts)
+        for clients in self.args.clients:
+            self.deployBenchmark(clients)
+        if self.args.stages:
+            print
+            print tracer.report()
+
+
+def compare(results, baseline_file):
+    baseline = {}
+    with open(baseline_file) as f:
+        for line in f:
+            record = json.loads(line)
+            baseline[(record['name'], record['size'])] = record
+    print
+    print '%-32s %8s %11s %11s %8s' % ('benchmark', 'size', 'baseline', 'now', 'ratio')
+    for record in results:
+        old = baseline.get((record['name'], record['size']))
+        if old is not None:
+            print '%-32s %8s %10.4fs %10.4fs %7.2fx' % (record['name'], record['size'], old['best'], record['best'],
+                record['best'] / old['best'] if old['best'] else 0)
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',') if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='deploy-splunk benchmarks against a local cmdb stub')
+    parser.add_argument('--accounts', type=int_list, default=[1, 10, 100, 1000],
+        help='comma separated numbers of aws accounts per customer (default 1,10,100,1000)')
+    parser.add_argument('--clients', type=int_list, default=[1, 10],
+        help='comma separated batch sizes for the end-to-end deploy (default 1,10)')
+    parser.add_argument('--accounts-per-client', type=int, default=3)
+    parser.add_argument('--instances', type=int, default=200)
+    parser.add_argument('--security-groups', type=int, default=50)
+    parser.add_argument('--rules', type=int, default=4)
+    parser.add_argument('--per-page', type=int, default=25)
+    parser.add_argument('--page-workers', type=int, default=4)
+    parser.add_argument('--deploy-workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every cmdb response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of cmdb responses that are http 500')
+    parser.add_argument('--timeout-rate', type=float, default=0, help='fraction of cmdb responses that time out')
+    parser.add_argument('--timeout', type=float, default=5, help='cmdb client socket timeout')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--label', help='label of the results (default git describe)')
+    parser.add_argument('--output', help='append results as json lines to this file')
+    parser.add_argument('--compare', help='json lines file of an earlier run to compare with')
+    parser.add_argument('--stages', action='store_true', help='print the per-stage timing report')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    benchmark = Benchmark(args)
+    try:
+        benchmark.run()
+    finally:
+        benchmark.close()
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            for record in benchmark.results:
+                f.write(json.dumps(record) + '\n')
+    if args.compare:
+        compare(benchmark.results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
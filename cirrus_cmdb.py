@@ -2,10 +2,19 @@
 import logging
 import socket
 import sys
+import threading
+import httplib
 import httplib2
 import json
+import random
 import urllib
-from time import sleep
+import urlparse
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+from cmdb_records import SecurityGroupRule, record_types
+from timing import tracer
 
 __author__ = 'richard'
 
@@ -16,23 +25,273 @@ class Http500Exception(Exception):
     def __str__(self):
         return repr(self.parameter)
 
-class CirrusCmdb(object):
+class CmdbUnavailableException(Exception):
+    def __init__(self, value=None):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
+
+class RetryPolicy(object):
+    """
+    exponential backoff with full jitter and a budget of max_elapsed seconds per query for its failed
+    attempts and backoff, shared by all its pages (see RetryBudget)
+    """
+
+    def __init__(self, base_delay=1, max_delay=30, max_elapsed=120, max_parse_retries=5):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.max_parse_retries = max_parse_retries
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+class RetryBudget(object):
+    """
+    seconds a query has spent on failed attempts and backoff, successful pages and
+    the time callers take between pages don't count
+    """
+
+    def __init__(self, max_elapsed):
+        self.max_elapsed = max_elapsed
+        self.spent = 0.0
+        self._lock = threading.Lock()
+
+    def spend(self, seconds):
+        with self._lock:
+            self.spent += seconds
+
+    def allows(self, delay):
+        with self._lock:
+            return self.spent + delay <= self.max_elapsed
+
+class CircuitBreaker(object):
+    """
+    per host circuit breaker: opens after failure_threshold consecutive failures and lets
+    a single trial request through once reset_timeout has passed
+    """
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_host(cls, host):
+        with cls._breakers_lock:
+            if host not in cls._breakers:
+                cls._breakers[host] = cls()
+            return cls._breakers[host]
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._trial_running else 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._trial_running and time() - self.opened_at >= self.reset_timeout:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running:
+                self._trial_running = False
+                self.opened_at = time()
+            elif self.opened_at is None and self.failures >= self.failure_threshold:
+                self.opened_at = time()
+                self.trips += 1
+
+class ConnectionPool(object):
+    """
+    keep-alive httplib2 connections shared by every CirrusCmdb instance and thread using the same
+    cmdb and credentials, at most size connections are open and each is used by one thread at a time
+    """
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, user, password, ignore_ssl=False, timeout=5, size=10, health_ttl=10):
+        self.user = user
+        self.password = password
+        self.ignore_ssl = ignore_ssl
+        self.timeout = timeout
+        self.size = size
+        self.health_ttl = health_ttl
+        self.created = 0
+        self.in_use = 0
+        self.requests = 0
+        self.health_checks = 0
+        self._idle = []
+        self._health = {}
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_host(cls, host, user, password, ignore_ssl=False, timeout=5, size=10):
+        key = (host, user, password, ignore_ssl, timeout, size)
+        with cls._pools_lock:
+            if key not in cls._pools:
+                cls._pools[key] = cls(user, password, ignore_ssl, timeout, size)
+            return cls._pools[key]
+
+    def _new_http(self):
+        http = httplib2.Http(disable_ssl_certificate_validation=self.ignore_ssl, timeout=self.timeout)
+        http.add_credentials(self.user, self.password)
+        return http
+
+    def _set_timeout(self, http, timeout):
+        http.timeout = timeout
+        for conn in http.connections.values():
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+
+    @contextmanager
+    def connection(self):
+        """
+        borrows an idle connection (or opens a new one), waiting while all size connections are in use,
+        a connection whose request raised is dropped instead of going back to the pool
+        """
+        self._slots.acquire()
+        with self._lock:
+            http = self._idle.pop() if self._idle else None
+            if http is None:
+                self.created += 1
+            self.in_use += 1
+        reusable = False
+        try:
+            if http is None:
+                http = self._new_http()
+            yield http
+            reusable = True
+        finally:
+            with self._lock:
+                self.in_use -= 1
+                if reusable:
+                    self._idle.append(http)
+            self._slots.release()
+
+    def request(self, url, method='GET', timeout=None):
+        with self.connection() as http:
+            with self._lock:
+                self.requests += 1
+            if timeout is None:
+                return http.request(url, method)
+            self._set_timeout(http, timeout)
+            try:
+                return http.request(url, method)
+            finally:
+                self._set_timeout(http, self.timeout)
+
+    def healthy(self, url, timeout=None):
+        """
+        True if url answers a HEAD request, the result is reused for health_ttl seconds
+        so parallel deploys check the cmdb once
+        """
+        with self._lock:
+            checked = self._health.get(url)
+            if checked is not None and time() - checked[0] < self.health_ttl:
+                return checked[1]
+            self.health_checks += 1
+        try:
+            self.request(url, 'HEAD', timeout)
+            ok = True
+        except (socket.error, httplib2.ServerNotFoundError):
+            ok = False
+        with self._lock:
+            self._health[url] = (time(), ok)
+        return ok
+
+    def stats(self):
+        with self._lock:
+            return { 'size': self.size, 'in_use': self.in_use, 'idle': len(self._idle), 'created': self.created,
+                     'requests': self.requests, 'health_checks': self.health_checks }
+
 
-    def __init__(self, base_api_url, user, password, ignore_ssl=False):
+class CirrusCmdb(object):
+    #number of security group ids sent in one q[security_group_id_in] query
+    rules_batch_size = 50
+    #number of customer names or ids sent in one q[name_in] or q[customer_id_in] query
+    customers_batch_size = 50
+
+    def __init__(self, base_api_url, user, password, ignore_ssl=False, page_workers=1, prefetch_pages=None,
+                 cache=None, retry_policy=None, circuit_breaker=None, timeout=5, snapshot=None, pool_size=10,
+                 connection_pool=None, records=False):
         self._base_api_url = base_api_url
+        self._user = user
+        self._password = password
+        self._ignore_ssl = ignore_ssl
+        self._timeout = timeout
+
+        #connections are shared with the other clients of the same cmdb, see ConnectionPool
+        self._pool = connection_pool or ConnectionPool.for_host(urlparse.urlparse(base_api_url).netloc, user, password,
+            ignore_ssl, timeout, pool_size)
 
-        self._http = httplib2.Http(disable_ssl_certificate_validation=ignore_ssl, timeout=5)
-        self._http.add_credentials(user, password)
+        #page_workers > 1 fetches pages concurrently, each request on a connection borrowed from the pool
+        self._page_workers = page_workers
+        self._prefetch_pages = prefetch_pages or page_workers
+        self._page_pool = None
+        self._page_pool_lock = threading.Lock()
+
+        #optional cmdb_cache.ResponseCache, results are cached per query url
+        self._cache = cache
+
+        #optional cmdb_snapshot.CmdbSnapshot, answers lookups while fresh and when the cmdb is unavailable
+        self._snapshot = snapshot
+
+        #records=True returns cmdb_records slotted records instead of dictionaries
+        self._records = records
+
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._breaker = circuit_breaker or CircuitBreaker.for_host(urlparse.urlparse(base_api_url).netloc)
+        self._retries = 0
+        self._gave_up = 0
+        self._stats_lock = threading.Lock()
 
         self._logger = logging.getLogger('AuditEc2')
 
+    def close(self):
+        with self._page_pool_lock:
+            if self._page_pool is not None:
+                self._page_pool.terminate()
+                self._page_pool = None
+
     def _throttle(self, delay, name):
-        self._logger.warning('%s throttling - sleeping for %s seconds' % (name, str(delay)))
+        self._logger.warning('%s throttling - sleeping for %.1f seconds' % (name, delay))
         sleep(delay)
 
+    def retry_stats(self):
+        """
+        retry counters of this client and the state of the circuit breaker of its host
+        """
+        return { 'retries': self._retries,
+                 'gave_up': self._gave_up,
+                 'breaker_trips': self._breaker.trips,
+                 'breaker_state': self._breaker.state }
+
     def __prep_url(self, url, page):
         if page is not 1:
-            return url + '&page=%s' % str(page)
+            separator = '&' if '?' in url else '?'
+            return url + '%spage=%s' % (separator, str(page))
         else:
             return url
 
@@ -50,61 +309,203 @@ class CirrusCmdb(object):
         else:
             return tmp
 
-    def __run_query(self, query_url):
-        j_results = []
-
-        delay = 0
-        delay_increment = 5
-
-
-        page_loop = True
-
-        page = 1
-
-        while page_loop:
-
-            working_url = self.__prep_url(query_url, page)
-            retry_count = 0
-            timeout_loop = True
-            while timeout_loop:
+    def __get_page_pool(self):
+        # locked as AsyncCirrusCmdb workers share one client
+        with self._page_pool_lock:
+            if self._page_pool is None:
+                self._page_pool = ThreadPool(self._page_workers)
+            return self._page_pool
+
+    def __fetch_page(self, working_url, budget):
+        """
+        fetches a single page, retrying timeouts, connection and dns errors and http 500s with the retry policy
+        while the retry budget of the query lasts, returns list of results, None for an empty page or False if the
+        content can't be parsed, raises CmdbUnavailableException when the budget is spent or the circuit is open
+        """
+        with tracer.span('cmdb.page', url=working_url) as span:
+            policy = self._retry_policy
+
+            attempt = 0
+            parse_retries = 0
+            while True:
+                if not self._breaker.allow():
+                    raise CmdbUnavailableException('cmdb circuit open - %s' % working_url)
+
+                attempt_started = time()
                 try:
-                    response, content = self._http.request(working_url)
+                    response, content = self._pool.request(working_url)
+                    span.add(requests=1, bytes=len(content))
 
                     if response.status == 500:
                         raise Http500Exception
 
                 except socket.timeout:
-                    delay += delay_increment
-                    self._throttle(delay, 'cmdb socket timeout')
+                    reason = 'cmdb socket timeout'
+                except (socket.error, httplib2.ServerNotFoundError, httplib.HTTPException):
+                    reason = 'cmdb connection error'
                 except Http500Exception:
-                    delay += delay_increment
-                    self._throttle(delay, 'cmdb http 500')
+                    reason = 'cmdb http 500'
+                except Exception:
+                    # anything else still counts against the breaker, or a failed trial would keep it half-open
+                    self._breaker.record_failure()
+                    raise
                 else:
-
+                    self._breaker.record_success()
                     res = self.__process_content(content)
 
-                    if res is not False:
-                        timeout_loop = False
-                        if res is not None:
-                            j_results += res
-                            self._logger.info('cmdb - results found')
-                            if len(res) > 1:
-                                page += 1
-                                timeout_loop = False
-                            else:
-                                page_loop = False
-                        else:
-                            if j_results is not None and len(j_results) == 0:
-                                self._logger.info('cmdb - no results found return None %s' % query_url)
-                                j_results = None
-                            else:
-                                #we get here if we have come to the end of a multi page loop
-                                page_loop = False
-
-                    elif retry_count == 5:
-                        timeout_loop = False
-                    else:
-                        retry_count += 1
+                    if res is not False or parse_retries == policy.max_parse_retries:
+                        return res
+                    parse_retries += 1
+                    continue
+
+                self._breaker.record_failure()
+                budget.spend(time() - attempt_started)
+                delay = policy.delay(attempt)
+                attempt += 1
+                if not budget.allows(delay):
+                    with self._stats_lock:
+                        self._gave_up += 1
+                    raise CmdbUnavailableException('%s - gave up after %s attempts - %s' % (reason, attempt, working_url))
+
+                with self._stats_lock:
+                    self._retries += 1
+                span.add(retries=1)
+                budget.spend(delay)
+                self._throttle(delay, reason)
+
+    def __fetch_pages(self, query_url, budget):
+        """
+        generator of pages, asks for page N+1 once page N has been parsed
+        """
+        page = 1
+        while True:
+            res = self.__fetch_page(self.__prep_url(query_url, page), budget)
+            if not res:
+                return
+            yield res
+            if len(res) <= 1:
+                return
+            page += 1
+
+    def __fetch_pages_concurrently(self, query_url, budget):
+        """
+        generator of pages, keeps a window of prefetch_pages requests in flight on the page pool
+        and stops at the first empty page
+        """
+        pool = self.__get_page_pool()
+        pending = deque()
+        next_page = 1
+        while True:
+            while len(pending) < self._prefetch_pages:
+                working_url = self.__prep_url(query_url, next_page)
+                pending.append(pool.apply_async(self.__fetch_page, (working_url, budget)))
+                next_page += 1
+
+            res = pending.popleft().get()
+            if not res:
+                return
+            yield res
+            if len(res) <= 1:
+                return
+
+    def invalidate_cache(self, prefix=None):
+        """
+        drops cached results for urls starting with prefix (relative to the api url), or all of them
+        """
+        if self._cache is not None:
+            self._cache.invalidate(self._base_api_url + prefix if prefix is not None else None)
+
+    def __run_query(self, query_url):
+        return self.__to_records(query_url, self.__run_snapshot_query(query_url))
+
+    def __run_snapshot_query(self, query_url):
+        if self._snapshot is None:
+            return self.__run_cached_query(query_url)
+
+        found, j_results = self._snapshot.lookup(query_url)
+        if found:
+            return j_results
+        try:
+            return self.__run_cached_query(query_url)
+        except CmdbUnavailableException, err:
+            found, j_results = self._snapshot.lookup(query_url, stale=True)
+            if not found:
+                raise
+            self._logger.warning('%s - answered from stale snapshot' % err)
+            return j_results
+
+    def sync_snapshot(self, collections=None, full=False):
+        return self._snapshot.sync(self, collections, full)
+
+    def iter_collection(self, collection, updated_since=None):
+        """
+        generator of every record of a collection, or of the ones updated since an updated_at value,
+        always fetched from the cmdb
+        """
+        query_url = self._base_api_url + '/%s.json' % collection
+        if updated_since is not None:
+            query_url += '?' + urllib.urlencode({ 'q[updated_at_gteq]': updated_since })
+
+        for res in self.__iter_pages(query_url):
+            for row in res:
+                yield row
+
+    def __run_cached_query(self, query_url):
+        if self._cache is None:
+            return self.__run_uncached_query(query_url)
+
+        found, j_results = self._cache.get(query_url)
+        if not found:
+            j_results = self.__run_uncached_query(query_url)
+            self._cache.set(query_url, j_results)
+        return j_results
+
+    def __iter_pages(self, query_url):
+        budget = RetryBudget(self._retry_policy.max_elapsed)
+        if self._page_workers > 1:
+            pages = self.__fetch_pages_concurrently(query_url, budget)
+        else:
+            pages = self.__fetch_pages(query_url, budget)
+
+        with tracer.span('cmdb.query', url=query_url) as span:
+            for res in pages:
+                span.add(pages=1, rows=len(res))
+                self._logger.info('cmdb - results found')
+                yield res
+
+    def __iter_query(self, query_url):
+        """
+        generator of results, yields the rows of a page before the next page is asked for,
+        so only one page (or the prefetch window) is in memory at a time.
+        with a cache or snapshot the whole result is looked up and iterated over instead
+        """
+        if self._cache is not None or self._snapshot is not None:
+            for row in self.__run_query(query_url) or []:
+                yield row
+            return
+
+        for res in self.__iter_pages(query_url):
+            for row in self.__to_records(query_url, res):
+                yield row
+
+    def __to_records(self, query_url, j_results):
+        if not self._records or j_results is None:
+            return j_results
+        collection = urlparse.urlparse(query_url).path.rsplit('/', 1)[-1].replace('.json', '')
+        record_type = record_types.get(collection)
+        if record_type is None:
+            return j_results
+        return [record_type.from_dict(row) for row in j_results]
+
+    def __run_uncached_query(self, query_url):
+        j_results = []
+
+        for res in self.__iter_pages(query_url):
+            j_results += res
+
+        if len(j_results) == 0:
+            self._logger.info('cmdb - no results found return None %s' % query_url)
+            return None
 
         return j_results
 
@@ -128,6 +529,12 @@ class CirrusCmdb(object):
             return None
 
 
+    def iter_instance_all_by_aws_account_number(self, aws_account_number):
+        cmdb_account_id = self.__get_aws_account_id(aws_account_number)
+        query_url = self._base_api_url + '/aws_instances.json?q[aws_account_id_equals]=%s' % cmdb_account_id
+
+        return self.__iter_query(query_url)
+
     def get_aws_account_details(self, aws_account_number):
         query_url = self._base_api_url + '/aws_accounts.json?q[number_equals]=%s' % aws_account_number
         #response, content = self._http.request(query_url)
@@ -226,30 +633,51 @@ class CirrusCmdb(object):
         return content
 
 
-    def get_all_security_group_rules_by_aws_account_number(self, aws_account_number):
-        security_groups = self.get_all_security_groups_by_aws_account_number(aws_account_number)
+    def iter_all_security_groups_by_aws_account_number(self, aws_account_number):
+        cmdb_account_id = self.__get_aws_account_id(aws_account_number)
+        query_url = self._base_api_url + '/aws_security_groups.json?q[aws_account_id_equals]=%s' % cmdb_account_id
+
+        return self.__iter_query(query_url)
 
-        rules = []
+    def get_security_group_rules(self, security_groups, batch_size=None):
+        """
+        returns the rules open to 0.0.0.0 for many security groups, fetched in batches of
+        q[security_group_id_in] filters, in the same order as querying group by group
+        """
+        return list(self.iter_security_group_rules(security_groups, batch_size))
 
-        for sg in security_groups:
-            rules_query = self._base_api_url + '/aws_security_group_rules.json?q[security_group_id_equals]=%s&q[ip_range_contains]=0.0.0.0' % sg['id']
+    def iter_security_group_rules(self, security_groups, batch_size=None):
+        """
+        generator of the rules of get_security_group_rules, the rules of a batch of groups
+        are yielded before the next batch is fetched
+        """
+        batch_size = batch_size or self.rules_batch_size
 
-            sg_rules = self.__run_query(rules_query)
+        for i in range(0, len(security_groups), batch_size):
+            batch = security_groups[i:i + batch_size]
+            params_url = urllib.urlencode([('q[security_group_id_in][]', sg['id']) for sg in batch])
+            rules_query = self._base_api_url + '/aws_security_group_rules.json?%s&q[ip_range_contains]=0.0.0.0' % params_url
 
-            if sg_rules is not None:
+            rules_by_group = {}
+            for rule in self.__iter_query(rules_query):
+                rules_by_group.setdefault(rule['security_group_id'], []).append(rule)
+
+            for sg in batch:
                 #add data from security group to each rule, as the out put for SG's have this data formatted like this
                 #for output to splunk's event based
-                for a in sg_rules:
-                    a['description'] = sg['description']
-                    a['region'] = sg['region']
-                    a['name'] = sg['name']
+                for a in rules_by_group.get(sg['id'], []):
+                    if isinstance(a, SecurityGroupRule):
+                        a.group = sg
+                    else:
+                        a['description'] = sg['description']
+                        a['region'] = sg['region']
+                        a['name'] = sg['name']
+                    yield a
 
-                rules.extend(sg_rules)
+    def get_all_security_group_rules_by_aws_account_number(self, aws_account_number):
+        security_groups = self.get_all_security_groups_by_aws_account_number(aws_account_number)
 
-        if rules is not None:
-            return rules
-        else:
-            return None
+        return self.get_security_group_rules(security_groups or [])
 
     def get_customer_details(self, customer_name):
         params_url = urllib.urlencode({'q[name_equals]':customer_name})
@@ -262,6 +690,23 @@ class CirrusCmdb(object):
             self._logger.critical('customer details not found: %s' % customer_name)
             return None
 
+    def get_all_customers(self):
+        query_url = self._base_api_url + '/customers.json'
+        content = self.__run_query(query_url)
+
+        return content
+
+    def iter_all_customers(self):
+        return self.__iter_query(self._base_api_url + '/customers.json')
+
+    def iter_all_aws_account_numbers(self, customer_name):
+        customer = self.get_customer_details(customer_name)
+        if customer is None:
+            return iter([])
+        query_url = self._base_api_url + '/aws_accounts.json?q[customer_id_equals]=%s' % customer['id']
+
+        return self.__iter_query(query_url)
+
     def get_all_aws_account_numbers(self, customer_name):
         content = []
         customer = self.get_customer_details(customer_name)
@@ -271,13 +716,38 @@ class CirrusCmdb(object):
             content = self.__run_query(query_url)
         return content
 
+    def get_aws_accounts_by_customer_names(self, customer_names, batch_size=None):
+        """
+        resolves many customers and their aws accounts with batched q[name_in] and q[customer_id_in]
+        queries instead of two queries per customer, returns dictionary of customer name to list of
+        aws accounts, empty for unknown customers and customers without accounts
+        """
+        batch_size = batch_size or self.customers_batch_size
+        names = []
+        for name in customer_names:
+            if name not in names:
+                names.append(name)
+
+        customers = {}
+        for i in range(0, len(names), batch_size):
+            params_url = urllib.urlencode([('q[name_in][]', name) for name in names[i:i + batch_size]])
+            for customer in self.__iter_query(self._base_api_url + '/customers.json?%s' % params_url):
+                customers.setdefault(customer['name'], customer)
+
+        customer_ids = [customers[name]['id'] for name in names if name in customers]
+        accounts = dict((customer_id, []) for customer_id in customer_ids)
+        for i in range(0, len(customer_ids), batch_size):
+            params_url = urllib.urlencode([('q[customer_id_in][]', c) for c in customer_ids[i:i + batch_size]])
+            for account in self.__iter_query(self._base_api_url + '/aws_accounts.json?%s' % params_url):
+                accounts.setdefault(account['customer_id'], []).append(account)
+
+        return dict((name, accounts[customers[name]['id']] if name in customers else []) for name in names)
+
     def can_connect(self):
-        try:
-            c = self._http.request(self._base_api_url)
-            return True
-        except socket.timeout:
-            return False
-        except socket.error:
-            return False
-        except httplib2.ServerNotFoundError:
-            return False
\ No newline at end of file
+        """
+        HEAD request to the api url, the answer is shared by all clients of the pool for a few seconds
+        """
+        return self._pool.healthy(self._base_api_url)
+
+    def pool_stats(self):
+        return self._pool.stats()
@@ -0,0 +1,54 @@
+from multiprocessing.pool import ThreadPool
+from cirrus_cmdb import CirrusCmdb
+
+__author__ = 'jakub.zygmunt'
+
+
+def _async(name):
+    def method(self, *args, **kwargs):
+        callback = kwargs.pop('callback', None)
+        return self._pool.apply_async(getattr(self.cmdb, name), args, kwargs, callback)
+    method.__name__ = name
+    method.__doc__ = 'non-blocking CirrusCmdb.%s, returns an AsyncResult' % name
+    return method
+
+
+class AsyncCirrusCmdb(object):
+    """
+    non-blocking front end to CirrusCmdb: every lookup returns straight away with an
+    AsyncResult (pass callback= to be notified), while the requests, paging and retry
+    backoff run on a shared pool of worker threads, borrowing keep-alive connections
+    from the cmdb's ConnectionPool
+    """
+
+    def __init__(self, base_api_url=None, user=None, password=None, ignore_ssl=False, workers=8, cmdb=None, **kwargs):
+        self.cmdb = cmdb or CirrusCmdb(base_api_url, user, password, ignore_ssl=ignore_ssl, **kwargs)
+        self._pool = ThreadPool(workers)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.cmdb.close()
+
+    def gather(self, results, timeout=None):
+        """
+        waits for a list of AsyncResults and returns their values in the same order
+        """
+        return [r.get(timeout) for r in results]
+
+    can_connect = _async('can_connect')
+    get_all_customers = _async('get_all_customers')
+    get_customer_details = _async('get_customer_details')
+    get_all_aws_account_numbers = _async('get_all_aws_account_numbers')
+    get_aws_accounts_by_customer_names = _async('get_aws_accounts_by_customer_names')
+    get_aws_account_details = _async('get_aws_account_details')
+    get_aws_keys = _async('get_aws_keys')
+    get_instance_all_by_aws_account_number = _async('get_instance_all_by_aws_account_number')
+    get_instance_by_id = _async('get_instance_by_id')
+    get_instance_reviewed_dates = _async('get_instance_reviewed_dates')
+    get_volume_reviewed_at = _async('get_volume_reviewed_at')
+    get_snapshot_reviewed_at = _async('get_snapshot_reviewed_at')
+    get_security_group_reviewed_at = _async('get_security_group_reviewed_at')
+    get_all_security_groups_by_aws_account_number = _async('get_all_security_groups_by_aws_account_number')
+    get_security_group_rules = _async('get_security_group_rules')
+    get_all_security_group_rules_by_aws_account_number = _async('get_all_security_group_rules_by_aws_account_number')
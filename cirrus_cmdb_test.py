@@ -0,0 +1,366 @@
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+import logging
+import threading
+import httplib
+import httplib2
+import cirrus_cmdb
+from multiprocessing.pool import ThreadPool
+from cirrus_cmdb import CirrusCmdb, CmdbUnavailableException, RetryPolicy, CircuitBreaker, ConnectionPool
+from cmdb_cache import ResponseCache
+from cmdb_snapshot import CmdbSnapshot
+from cmdb_records import AwsAccount, SecurityGroupRule
+from cirrus_cmdb_async import AsyncCirrusCmdb
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files'))
+from cmdb_stub import CmdbStub
+
+__author__ = 'jakub.zygmunt'
+
+class CirrusCmdbTest(unittest.TestCase):
+    def setUp(self):
+        """
+        start a local cmdb stub with one account and a few pages of instances
+        """
+        logging.basicConfig()
+        self.collections = {
+            'customers': [ { 'id': 1, 'name': 'Wigy Wigy' } ],
+            'aws_accounts': [ { 'id': 10, 'customer_id': 1, 'number': '1111-2222-3333',
+                               'access_key_id': 'AKIA', 'secret_key': 'secret' } ],
+            'aws_instances': [ { 'id': x, 'aws_account_id': 10, 'instance_id': 'i-%05d' % x } for x in range(1, 61) ],
+            'aws_security_groups': [ { 'id': x, 'aws_account_id': 10, 'name': 'sg-%s' % x,
+                                       'description': 'group %s' % x, 'region': 'eu-west-1' } for x in range(1, 6) ],
+            'aws_security_group_rules': [ { 'id': x, 'security_group_id': 5 - x % 5, 'port': x,
+                                            'ip_range': '0.0.0.0/0' if x % 3 else '10.0.0.0/8' } for x in range(1, 21) ],
+        }
+        self.stub = CmdbStub(self.collections, per_page=25).start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def getCmdb(self, **kwargs):
+        return CirrusCmdb(base_api_url=self.stub.url, user='a', password='b', **kwargs)
+
+    def testShouldReturnAllPagesSequentially(self):
+        cmdb = self.getCmdb()
+        instances = cmdb.get_instance_all_by_aws_account_number('1111-2222-3333')
+        self.assertEqual(self.collections['aws_instances'], instances)
+        self.assertEqual(4, len(self.stub.requestsFor('aws_instances')))
+
+    def testShouldReturnAllPagesConcurrently(self):
+        cmdb = self.getCmdb(page_workers=4)
+        instances = cmdb.get_instance_all_by_aws_account_number('1111-2222-3333')
+        cmdb.close()
+        self.assertEqual(self.collections['aws_instances'], instances)
+
+    def testConcurrentPagingShouldStopAtFirstEmptyPage(self):
+        cmdb = self.getCmdb(page_workers=2, prefetch_pages=3)
+        instances = cmdb.get_instance_all_by_aws_account_number('1111-2222-3333')
+        cmdb.close()
+        requested_pages = len(self.stub.requestsFor('aws_instances'))
+        self.assertEqual(60, len(instances))
+        self.assertTrue(requested_pages <= 6, msg='Requested %s pages' % requested_pages)
+
+    def testShouldReturnNoneForEmptyResults(self):
+        cmdb = self.getCmdb(page_workers=4)
+        instances = cmdb.get_instance_by_id('i-99999')
+        cmdb.close()
+        self.assertEqual(None, instances)
+
+    def testClientsShouldShareKeepAliveConnections(self):
+        self.getCmdb().get_customer_details('Wigy Wigy')
+        cmdb = self.getCmdb()
+        cmdb.get_instance_all_by_aws_account_number('1111-2222-3333')
+        stats = cmdb.pool_stats()
+        self.assertEqual(1, stats['created'])
+        self.assertEqual(1, stats['idle'])
+        self.assertEqual(0, stats['in_use'])
+
+    def testConnectionPoolShouldBoundConcurrentConnections(self):
+        pool = ConnectionPool('a', 'b', size=2)
+        cmdb = self.getCmdb(page_workers=4, connection_pool=pool)
+        instances = cmdb.get_instance_all_by_aws_account_number('1111-2222-3333')
+        cmdb.close()
+        self.assertEqual(self.collections['aws_instances'], instances)
+        self.assertTrue(pool.stats()['created'] <= 2)
+
+    def testSharedPoolsShouldKeepTheirSize(self):
+        pool = ConnectionPool.for_host('cmdb.example.com', 'a', 'b', size=2)
+        self.assertTrue(pool is ConnectionPool.for_host('cmdb.example.com', 'a', 'b', size=2))
+        self.assertEqual(4, ConnectionPool.for_host('cmdb.example.com', 'a', 'b', size=4).size)
+
+    def testHealthCheckShouldBeSharedByClients(self):
+        self.assertTrue(self.getCmdb().can_connect())
+        self.assertTrue(self.getCmdb().can_connect())
+        self.assertEqual(1, len([r for r in self.stub.requests if r in ('', '/')]))
+        self.assertFalse(CirrusCmdb('http://completelywrong.dns.name.to.be.sure.it.wont.work', 'a', 'b').can_connect())
+
+    def testIteratorShouldYieldRowsBeforeFetchingNextPage(self):
+        cmdb = self.getCmdb()
+        instances = cmdb.iter_instance_all_by_aws_account_number('1111-2222-3333')
+        self.assertEqual(self.collections['aws_instances'][0], next(instances))
+        self.assertEqual(1, len(self.stub.requestsFor('aws_instances')))
+        self.assertEqual(self.collections['aws_instances'][1:], list(instances))
+        self.assertEqual(4, len(self.stub.requestsFor('aws_instances')))
+
+    def testIteratorsShouldReturnSameRowsAsGetters(self):
+        cmdb = self.getCmdb(page_workers=2)
+        cmdb.rules_batch_size = 2
+        self.assertEqual(cmdb.get_all_aws_account_numbers('Wigy Wigy'), list(cmdb.iter_all_aws_account_numbers('Wigy Wigy')))
+        self.assertEqual([], list(cmdb.iter_all_aws_account_numbers('Nobody')))
+        self.assertEqual(cmdb.get_all_customers(), list(cmdb.iter_all_customers()))
+        groups = list(cmdb.iter_all_security_groups_by_aws_account_number('1111-2222-3333'))
+        self.assertEqual(cmdb.get_security_group_rules(groups), list(cmdb.iter_security_group_rules(groups)))
+        cmdb.close()
+
+    def testShouldReturnSecurityGroupRulesInGroupOrder(self):
+        expectedList = []
+        for sg in self.collections['aws_security_groups']:
+            for rule in self.collections['aws_security_group_rules']:
+                if rule['security_group_id'] == sg['id'] and '0.0.0.0' in rule['ip_range']:
+                    expectedRule = dict(rule)
+                    expectedRule.update(description=sg['description'], region=sg['region'], name=sg['name'])
+                    expectedList.append(expectedRule)
+
+        cmdb = self.getCmdb()
+        cmdb.rules_batch_size = 2
+        rules = cmdb.get_all_security_group_rules_by_aws_account_number('1111-2222-3333')
+        self.assertEqual(expectedList, rules)
+        self.assertEqual(3, len([r for r in self.stub.requestsFor('aws_security_group_rules') if 'page=' not in r]))
+
+    def testShouldResolveAccountsOfManyCustomersInBatches(self):
+        for c in range(2, 6):
+            self.collections['customers'].append({ 'id': c, 'name': 'Customer %s' % c })
+            for a in range(c):
+                self.collections['aws_accounts'].append({ 'id': c * 10 + a, 'customer_id': c, 'number': '%s-%s' % (c, a) })
+        names = ['Customer 5', 'Wigy Wigy', 'Nobody', 'Customer 2', 'Customer 3', 'Customer 4']
+        expected = dict((name, self.getCmdb().get_all_aws_account_numbers(name) or []) for name in names)
+        requests = len(self.stub.requests)
+
+        cmdb = self.getCmdb()
+        cmdb.customers_batch_size = 4
+        self.assertEqual(expected, cmdb.get_aws_accounts_by_customer_names(names + ['Wigy Wigy']))
+        self.assertEqual(4, len([r for r in self.stub.requests[requests:] if 'page=' not in r]))
+
+    def testRecordsShouldHoldOnlyUsedFields(self):
+        cmdb = self.getCmdb(records=True, cache=ResponseCache(ttl=60))
+        accounts = cmdb.get_all_aws_account_numbers('Wigy Wigy')
+        self.assertEqual([AwsAccount(id=10, customer_id=1, number='1111-2222-3333', access_key_id='AKIA',
+                                     secret_key='secret')], accounts)
+        self.assertEqual('1111-2222-3333', accounts[0]['number'])
+        self.assertRaises(AttributeError, setattr, accounts[0], 'extra', 1)
+        self.assertEqual(('AKIA', 'secret'), cmdb.get_aws_keys('1111-2222-3333'))
+
+    def testRecordRulesShouldReferenceTheirGroup(self):
+        expectedRules = self.getCmdb().get_all_security_group_rules_by_aws_account_number('1111-2222-3333')
+        rules = self.getCmdb(records=True).get_all_security_group_rules_by_aws_account_number('1111-2222-3333')
+        self.assertTrue(all(isinstance(rule, SecurityGroupRule) for rule in rules))
+        self.assertEqual(expectedRules, [rule.to_dict() for rule in rules])
+        self.assertTrue(rules[0].group is rules[1].group)
+        self.assertEqual(rules[0].group['name'], rules[0]['name'])
+
+    def testCachedLookupsShouldSkipTheNetwork(self):
+        cache = ResponseCache(ttl=60)
+        cmdb = self.getCmdb(cache=cache)
+        cmdb.get_aws_keys('1111-2222-3333')
+        cmdb.get_aws_account_details('1111-2222-3333')
+        cmdb.get_aws_keys('1111-2222-3333')
+        self.assertEqual(1, len(self.stub.requestsFor('aws_accounts')))
+        self.assertEqual({ 'hits': 2, 'misses': 1, 'size': 1 }, cache.stats())
+
+    def testInvalidateShouldDropCachedResults(self):
+        cache = ResponseCache(ttl=60)
+        cmdb = self.getCmdb(cache=cache)
+        cmdb.get_customer_details('Wigy Wigy')
+        cmdb.invalidate_cache('/customers.json')
+        cmdb.get_customer_details('Wigy Wigy')
+        self.assertEqual(2, len(self.stub.requestsFor('customers')))
+
+    def testCacheShouldExpireAndEvictEntries(self):
+        cache = ResponseCache(ttl=0)
+        cache.set('a', [1])
+        self.assertEqual((False, None), cache.get('a'))
+        cache = ResponseCache(ttl=60, max_size=2)
+        for key in ['a', 'b', 'c']:
+            cache.set(key, [key])
+        self.assertEqual((False, None), cache.get('a'))
+        self.assertEqual((True, ['c']), cache.get('c'))
+
+    def testPersistentCacheShouldBeSharedBetweenRuns(self):
+        folder = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(folder, 'cmdb.cache')
+            self.getCmdb(cache=ResponseCache(ttl=60, filename=cache_file)).get_customer_details('Wigy Wigy')
+            customer = self.getCmdb(cache=ResponseCache(ttl=60, filename=cache_file)).get_customer_details('Wigy Wigy')
+            self.assertEqual(self.collections['customers'][0], customer)
+            self.assertEqual(1, len(self.stub.requestsFor('customers')))
+            self.assertEqual(0600, os.stat(cache_file).st_mode & 0777)
+        finally:
+            shutil.rmtree(folder)
+
+    def testPersistentCacheShouldExpireAndEvictRows(self):
+        folder = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(folder, 'cmdb.cache')
+            cache = ResponseCache(ttl=60, max_size=2, filename=cache_file)
+            for key in ['a', 'b']:
+                cache.set(key, [key])
+            cache.get('a')
+            cache.set('c', ['c'])
+            cache = ResponseCache(ttl=60, max_size=2, filename=cache_file)
+            self.assertEqual([(True, ['a']), (False, None), (True, ['c'])], [cache.get(key) for key in ['a', 'b', 'c']])
+
+            cache = ResponseCache(ttl=0, filename=cache_file)
+            self.assertEqual((False, None), cache.get('a'))
+            cache.set('d', ['d'])
+            self.assertEqual(0, cache._db.execute('SELECT count(*) FROM responses').fetchone()[0])
+        finally:
+            shutil.rmtree(folder)
+
+    def testSnapshotShouldAnswerLookupsWithoutTheNetwork(self):
+        snapshot = CmdbSnapshot(':memory:', max_age=60)
+        cmdb = self.getCmdb(snapshot=snapshot)
+        expectedRules = self.getCmdb().get_all_security_group_rules_by_aws_account_number('1111-2222-3333')
+        self.assertEqual(4, len(cmdb.sync_snapshot()))
+        requests = len(self.stub.requests)
+
+        self.assertEqual(self.collections['aws_accounts'], cmdb.get_all_aws_account_numbers('Wigy Wigy'))
+        self.assertEqual(expectedRules, cmdb.get_all_security_group_rules_by_aws_account_number('1111-2222-3333'))
+        self.assertEqual(None, cmdb.get_customer_details('Nobody'))
+        self.assertEqual(requests, len(self.stub.requests))
+
+    def testSnapshotFileShouldBeReadableByOwnerOnly(self):
+        folder = tempfile.mkdtemp()
+        try:
+            snapshot_file = os.path.join(folder, 'cmdb.snapshot')
+            self.getCmdb(snapshot=CmdbSnapshot(snapshot_file)).sync_snapshot(['aws_accounts'])
+            self.assertEqual(0600, os.stat(snapshot_file).st_mode & 0777)
+        finally:
+            shutil.rmtree(folder)
+
+    def testSnapshotSyncShouldFetchOnlyUpdatedRecords(self):
+        for account in self.collections['aws_accounts']:
+            account['updated_at'] = '2016-01-01T10:00:00Z'
+        snapshot = CmdbSnapshot(':memory:', max_age=60)
+        cmdb = self.getCmdb(snapshot=snapshot)
+        cmdb.sync_snapshot(['aws_accounts'])
+        self.collections['aws_accounts'].append({ 'id': 11, 'customer_id': 1, 'number': '2222-3333-4444',
+                                                  'updated_at': '2016-02-01T10:00:00Z' })
+
+        self.assertEqual({ 'aws_accounts': 2 }, cmdb.sync_snapshot(['aws_accounts']))
+        self.assertTrue('updated_at_gteq' in self.stub.requestsFor('aws_accounts')[-1])
+        self.assertEqual(11, cmdb.get_aws_account_details('2222-3333-4444')[0]['id'])
+
+    def testStaleSnapshotShouldAnswerWhenCmdbIsUnavailable(self):
+        snapshot = CmdbSnapshot(':memory:', max_age=0)
+        cmdb = self.getCmdb(snapshot=snapshot, retry_policy=RetryPolicy(base_delay=0.01, max_delay=0.01, max_elapsed=0.1))
+        cmdb.sync_snapshot()
+        self.stub.failNext(100)
+        self.assertEqual(self.collections['customers'][0], cmdb.get_customer_details('Wigy Wigy'))
+        self.assertRaises(CmdbUnavailableException, cmdb.get_instance_by_id, 'i-00001')
+
+    def testStaleSnapshotShouldAnswerWhenCmdbHostIsNotFound(self):
+        snapshot = CmdbSnapshot(':memory:', max_age=0)
+        self.getCmdb(snapshot=snapshot).sync_snapshot()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        cmdb = CirrusCmdb(base_api_url='http://completelywrong.dns.name.to.be.sure.it.wont.work', user='a', password='b',
+                          snapshot=snapshot, circuit_breaker=breaker, retry_policy=RetryPolicy(base_delay=0, max_elapsed=0))
+        for attempt in range(2):
+            self.assertEqual(self.collections['customers'][0], cmdb.get_customer_details('Wigy Wigy'))
+        self.assertEqual('open', breaker.state)
+
+    def testAsyncClientShouldReturnSameResultsAsBlockingClient(self):
+        callbacks = []
+        async_cmdb = AsyncCirrusCmdb(base_api_url=self.stub.url, user='a', password='b', workers=4)
+        results = [ async_cmdb.get_all_aws_account_numbers('Wigy Wigy'),
+                    async_cmdb.get_instance_all_by_aws_account_number('1111-2222-3333'),
+                    async_cmdb.get_customer_details('Nobody', callback=callbacks.append) ]
+        accounts, instances, customer = async_cmdb.gather(results, timeout=30)
+        async_cmdb.close()
+        self.assertEqual(self.collections['aws_accounts'], accounts)
+        self.assertEqual(self.collections['aws_instances'], instances)
+        self.assertEqual(None, customer)
+        self.assertEqual([None], callbacks)
+
+    def testThreadsSharingClientShouldCreateOnePagePool(self):
+        created = []
+        class SlowThreadPool(ThreadPool):
+            def __init__(self, processes):
+                created.append(processes)
+                time.sleep(0.05)
+                ThreadPool.__init__(self, processes)
+        cmdb = self.getCmdb(page_workers=2)
+        cirrus_cmdb.ThreadPool = SlowThreadPool
+        try:
+            threads = [ threading.Thread(target=cmdb.get_instance_all_by_aws_account_number, args=('1111-2222-3333',))
+                        for i in range(8) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            cirrus_cmdb.ThreadPool = ThreadPool
+            cmdb.close()
+        self.assertEqual([2], created)
+
+    def testShouldRetryHttp500WithBackoff(self):
+        cmdb = self.getCmdb(retry_policy=RetryPolicy(base_delay=0.01, max_delay=0.05))
+        self.stub.failNext(2)
+        customer = cmdb.get_customer_details('Wigy Wigy')
+        self.assertEqual(self.collections['customers'][0], customer)
+        self.assertEqual(2, cmdb.retry_stats()['retries'])
+
+    def testShouldGiveUpWhenRetryBudgetIsSpent(self):
+        cmdb = self.getCmdb(retry_policy=RetryPolicy(base_delay=0.05, max_delay=0.05, max_elapsed=0.2),
+                            circuit_breaker=CircuitBreaker(failure_threshold=1000))
+        self.stub.failNext(100)
+        self.assertRaises(CmdbUnavailableException, cmdb.get_customer_details, 'Wigy Wigy')
+        self.assertEqual(1, cmdb.retry_stats()['gave_up'])
+
+    def testRetryBudgetShouldBeSharedByPagesOfQuery(self):
+        cmdb = self.getCmdb(retry_policy=RetryPolicy(base_delay=0, max_delay=0, max_elapsed=0.35),
+                            circuit_breaker=CircuitBreaker(failure_threshold=1000))
+        self.stub.latency = 0.1
+        rows = cmdb.iter_collection('aws_instances')
+        for i in range(25):
+            rows.next()
+        time.sleep(0.4)
+        self.stub.failNext(2)
+        for i in range(25):
+            rows.next()
+        self.assertEqual(2, cmdb.retry_stats()['retries'])
+        self.stub.failNext(2)
+        self.assertRaises(CmdbUnavailableException, list, rows)
+        self.assertEqual(3, cmdb.retry_stats()['retries'])
+        self.assertEqual(1, cmdb.retry_stats()['gave_up'])
+
+    def testFailedTrialShouldReopenCircuitWhateverItRaises(self):
+        errors = [httplib.BadStatusLine(''), httplib2.RedirectLimit('too many redirects', {}, '')]
+        pool = ConnectionPool('a', 'b')
+        class FailingPool(object):
+            def request(self, url, method='GET', timeout=None):
+                if errors:
+                    raise errors.pop(0)
+                return pool.request(url, method, timeout)
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        cmdb = self.getCmdb(connection_pool=FailingPool(), circuit_breaker=breaker,
+                            retry_policy=RetryPolicy(base_delay=0, max_elapsed=0))
+        self.assertRaises(CmdbUnavailableException, cmdb.get_customer_details, 'Wigy Wigy')
+        self.assertRaises(httplib2.RedirectLimit, cmdb.get_customer_details, 'Wigy Wigy')
+        self.assertEqual('open', breaker.state)
+        self.assertEqual(self.collections['customers'][0], cmdb.get_customer_details('Wigy Wigy'))
+        self.assertEqual('closed', breaker.state)
+
+    def testOpenCircuitShouldFailFast(self):
+        cmdb = self.getCmdb(retry_policy=RetryPolicy(base_delay=0.01, max_delay=0.01, max_elapsed=1))
+        self.stub.failNext(100)
+        self.assertRaises(CmdbUnavailableException, cmdb.get_customer_details, 'Wigy Wigy')
+        self.assertEqual('open', cmdb.retry_stats()['breaker_state'])
+        self.assertEqual(1, cmdb.retry_stats()['breaker_trips'])
+        requests = len(self.stub.requests)
+        self.assertRaises(CmdbUnavailableException, cmdb.get_customer_details, 'Wigy Wigy')
+        self.assertEqual(requests, len(self.stub.requests))
@@ -0,0 +1,126 @@
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'jakub.zygmunt'
+
+def connect_private(filename):
+    """
+    sqlite connection to filename, the file is made readable by its owner only
+    as cached cmdb rows include the aws credentials of every customer
+    """
+    if filename != ':memory:':
+        os.close(os.open(filename, os.O_RDWR | os.O_CREAT, 0600))
+        os.chmod(filename, 0600)
+    return sqlite3.connect(filename, check_same_thread=False)
+
+
+class ResponseCache(object):
+    """
+    TTL + LRU cache of cmdb query results keyed on the query url,
+    optionally persisted in a sqlite file so repeated runs can skip the network,
+    expired rows are deleted and the file is kept to max_size rows by last use too
+    """
+
+    def __init__(self, ttl=300, max_size=1024, filename=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        # urls answered from memory since the last write, their last use is saved with the next set
+        self._used = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if filename:
+            self._db = connect_private(filename)
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, stored_at REAL, content TEXT, '
+                             'used_at REAL)')
+            if 'used_at' not in [column[1] for column in self._db.execute('PRAGMA table_info(responses)')]:
+                self._db.execute('ALTER TABLE responses ADD COLUMN used_at REAL')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)')
+            self._db.commit()
+
+    def _isFresh(self, stored_at):
+        return time.time() - stored_at < self.ttl
+
+    def _loadFromDb(self, url):
+        row = self._db.execute('SELECT stored_at, content FROM responses WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        if not self._isFresh(row[0]):
+            self._db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self._db.commit()
+            return None
+        self._db.execute('UPDATE responses SET used_at = ? WHERE url = ?', (time.time(), url))
+        self._db.commit()
+        return row[0], json.loads(row[1])
+
+    def _pruneDb(self):
+        """
+        deletes expired rows and the least recently used ones above max_size
+        """
+        self._db.executemany('UPDATE responses SET used_at = ? WHERE url = ?', [(t, u) for u, t in self._used.items()])
+        self._used = {}
+        self._db.execute('DELETE FROM responses WHERE stored_at <= ?', (time.time() - self.ttl,))
+        self._db.execute('DELETE FROM responses WHERE url IN (SELECT url FROM responses ORDER BY used_at DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def _store(self, url, stored_at, value):
+        self._entries.pop(url, None)
+        self._entries[url] = (stored_at, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, url):
+        """
+        returns (True, value) on a hit and (False, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None and not self._isFresh(entry[0]):
+                entry = None
+            if entry is not None and self._db is not None:
+                self._used[url] = time.time()
+            if entry is None and self._db is not None:
+                entry = self._loadFromDb(url)
+
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self._store(url, entry[0], entry[1])
+            self.hits += 1
+            return True, copy.deepcopy(entry[1])
+
+    def set(self, url, value):
+        stored_at = time.time()
+        with self._lock:
+            self._store(url, stored_at, copy.deepcopy(value))
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO responses (url, stored_at, content, used_at) VALUES (?, ?, ?, ?)',
+                    (url, stored_at, json.dumps(value), stored_at))
+                self._pruneDb()
+                self._db.commit()
+
+    def invalidate(self, prefix=None):
+        """
+        drops every entry whose url starts with prefix, or the whole cache
+        """
+        with self._lock:
+            for url in [u for u in self._entries if prefix is None or u.startswith(prefix)]:
+                del self._entries[url]
+            if self._db is not None:
+                if prefix is None:
+                    self._db.execute('DELETE FROM responses')
+                else:
+                    self._db.execute('DELETE FROM responses WHERE substr(url, 1, ?) = ?', (len(prefix), prefix))
+                self._db.commit()
+
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'size': len(self._entries) }
@@ -0,0 +1,101 @@
+__author__ = 'jakub.zygmunt'
+
+class Record(object):
+    """
+    cmdb row holding only the fields deploys use, in slots instead of a dictionary,
+    fields can be read as attributes or items, so records work as jinja template context
+    """
+    __slots__ = ()
+    fields = ()
+    derived = ()
+
+    def __init__(self, **values):
+        for field in self.fields:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def from_dict(cls, row):
+        return cls(**dict((field, row.get(field)) for field in cls.fields))
+
+    def keys(self):
+        return list(self.fields + self.derived)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self else default
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __contains__(self, key):
+        return key in self.fields or key in self.derived
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.items() == other.items()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (f, getattr(self, f)) for f in self.fields))
+
+
+class Customer(Record):
+    fields = ('id', 'name')
+    __slots__ = fields
+
+
+class AwsAccount(Record):
+    fields = ('id', 'customer_id', 'number', 'name', 'access_key_id', 'secret_key')
+    __slots__ = fields
+
+
+class Instance(Record):
+    fields = ('id', 'aws_account_id', 'instance_id', 'region', 'reviewed_at', 'reviewed_sizing_at')
+    __slots__ = fields
+
+
+class SecurityGroup(Record):
+    fields = ('id', 'aws_account_id', 'name', 'description', 'region', 'reviewed_at')
+    __slots__ = fields
+
+
+class SecurityGroupRule(Record):
+    """
+    description, region and name are read from the parent security group instead of being copied into every rule
+    """
+    fields = ('id', 'security_group_id', 'port', 'ip_range', 'group')
+    derived = ('description', 'region', 'name')
+    __slots__ = fields
+
+    def keys(self):
+        return [f for f in self.fields if f != 'group'] + list(self.derived)
+
+    def __contains__(self, key):
+        return key != 'group' and Record.__contains__(self, key)
+
+    @property
+    def description(self):
+        return self.group['description'] if self.group is not None else None
+
+    @property
+    def region(self):
+        return self.group['region'] if self.group is not None else None
+
+    @property
+    def name(self):
+        return self.group['name'] if self.group is not None else None
+
+
+record_types = { 'customers': Customer,
+                 'aws_accounts': AwsAccount,
+                 'aws_instances': Instance,
+                 'aws_security_groups': SecurityGroup,
+                 'aws_security_group_rules': SecurityGroupRule }
@@ -0,0 +1,150 @@
+import json
+import re
+import threading
+import time
+import urlparse
+from cmdb_cache import connect_private
+
+__author__ = 'jakub.zygmunt'
+
+filter_re = re.compile(r'^q\[(\w+?)_(equals|in|contains)\](\[\])?$')
+
+
+def parse_query(query_url):
+    """
+    splits a cmdb query url into its collection and list of (field, operator, value) filters,
+    values of _in filters are lists, returns (None, None) for queries with other parameters
+    """
+    url = urlparse.urlparse(query_url)
+    name = url.path.rsplit('/', 1)[-1]
+    if not name.endswith('.json'):
+        return None, None
+
+    filters = []
+    in_values = {}
+    for key, value in urlparse.parse_qsl(url.query):
+        match = filter_re.match(key)
+        if match is None:
+            return None, None
+        if match.group(2) == 'in':
+            in_values.setdefault(match.group(1), []).append(value)
+        else:
+            filters.append((match.group(1), match.group(2), value))
+    filters.extend((field, 'in', values) for field, values in sorted(in_values.items()))
+    return name[:-len('.json')], filters
+
+
+def matches(row, filters):
+    for field, operator, value in filters:
+        field_value = '%s' % row.get(field)
+        if operator == 'equals' and field_value != value:
+            return False
+        if operator == 'in' and field_value not in value:
+            return False
+        if operator == 'contains' and value not in field_value:
+            return False
+    return True
+
+
+class CmdbSnapshot(object):
+    """
+    local sqlite replica of the cmdb collections deploys look up, synced incrementally
+    with q[updated_at_gteq] filters and indexed on the fields the lookups filter by,
+    lookups are answered while the last sync of a collection is younger than max_age
+    """
+    collections = ('customers', 'aws_accounts', 'aws_security_groups', 'aws_security_group_rules')
+    indexed_fields = ('name', 'number', 'customer_id', 'aws_account_id', 'security_group_id')
+
+    def __init__(self, filename, max_age=3600):
+        self.filename = filename
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = connect_private(filename)
+        self._db.execute('CREATE TABLE IF NOT EXISTS records (collection TEXT, id INTEGER, updated_at TEXT, %s, '
+                         'data TEXT, PRIMARY KEY (collection, id))' % ', '.join('%s TEXT' % f for f in self.indexed_fields))
+        for field in self.indexed_fields:
+            self._db.execute('CREATE INDEX IF NOT EXISTS records_%s ON records (collection, %s)' % (field, field))
+        self._db.execute('CREATE TABLE IF NOT EXISTS syncs (collection TEXT PRIMARY KEY, synced_at REAL, cursor TEXT)')
+        self._db.commit()
+
+    def _syncState(self, collection):
+        return self._db.execute('SELECT synced_at, cursor FROM syncs WHERE collection = ?', (collection,)).fetchone()
+
+    def _column(self, value):
+        return None if value is None else '%s' % value
+
+    def age(self, collection):
+        """
+        seconds since the collection was last synced, None if it never was
+        """
+        with self._lock:
+            state = self._syncState(collection)
+        return None if state is None else time.time() - state[0]
+
+    def sync(self, cmdb, collections=None, full=False):
+        """
+        fetches the records updated since the newest updated_at already stored (every record
+        on the first or a full sync, which also drops records deleted in the cmdb),
+        returns dictionary of collection to number of records fetched
+        """
+        fetched = {}
+        for collection in collections or self.collections:
+            with self._lock:
+                state = self._syncState(collection)
+            cursor = state[1] if state is not None and not full else None
+            started = time.time()
+            rows = list(cmdb.iter_collection(collection, updated_since=cursor))
+
+            with self._lock:
+                if full:
+                    self._db.execute('DELETE FROM records WHERE collection = ?', (collection,))
+                for row in rows:
+                    updated_at = row.get('updated_at')
+                    if updated_at is not None and (cursor is None or updated_at > cursor):
+                        cursor = updated_at
+                    self._db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, %s, ?)' % ', '.join('?' * len(self.indexed_fields)),
+                        [collection, row.get('id'), updated_at] + [self._column(row.get(f)) for f in self.indexed_fields] +
+                        [json.dumps(row)])
+                self._db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)', (collection, started, cursor))
+                self._db.commit()
+            fetched[collection] = len(rows)
+        return fetched
+
+    def lookup(self, query_url, stale=False):
+        """
+        answers a cmdb query url from the snapshot, returns (True, results or None) like the cmdb
+        would, or (False, None) when the collection isn't synced, its sync is older than max_age
+        (unless stale is True) or the query has filters the snapshot doesn't understand
+        """
+        collection, filters = parse_query(query_url)
+        with self._lock:
+            state = self._syncState(collection) if collection is not None else None
+            if state is None or (not stale and time.time() - state[0] > self.max_age):
+                self.misses += 1
+                return False, None
+
+            sql = 'SELECT data FROM records WHERE collection = ?'
+            params = [collection]
+            for field, operator, value in filters:
+                if operator == 'equals' and field in self.indexed_fields:
+                    sql += ' AND %s = ?' % field
+                    params.append(value)
+                elif operator == 'in' and field in self.indexed_fields:
+                    sql += ' AND %s IN (%s)' % (field, ', '.join('?' * len(value)))
+                    params.extend(value)
+            rows = [json.loads(data) for (data,) in self._db.execute(sql + ' ORDER BY id', params)]
+            self.hits += 1
+
+        rows = [row for row in rows if matches(row, filters)]
+        return True, rows or None
+
+    def stats(self):
+        with self._lock:
+            synced = dict((c, { 'synced_at': s, 'cursor': cur }) for c, s, cur in
+                          self._db.execute('SELECT collection, synced_at, cursor FROM syncs'))
+            for collection, count in self._db.execute('SELECT collection, count(*) FROM records GROUP BY collection'):
+                synced.setdefault(collection, {})['records'] = count
+        return { 'hits': self.hits, 'misses': self.misses, 'collections': synced }
@@ -0,0 +1,92 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from timing import Span, tracer
+
+__author__ = 'jakub.zygmunt'
+
+class Command(object):
+    """
+    subprocess with stdout and stderr merged, lines() streams the output lazily
+    and the whole process group is killed once it runs longer than timeout seconds
+    """
+
+    def __init__(self, cmd, timeout=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.returncode = None
+        self.timed_out = False
+        self.span = Span('command', time.time(), command=' '.join(cmd[:2]))
+
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            preexec_fn=os.setsid)
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self.kill)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.process.poll() is None:
+            self.kill(timed_out=False)
+        self.wait()
+
+    def kill(self, timed_out=True):
+        if self.process.poll() is None:
+            self.timed_out = timed_out
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def lines(self):
+        """
+        generator of output lines, reads until the end of the output so nothing
+        buffered after the process exits is lost
+        """
+        for line in iter(self.process.stdout.readline, ''):
+            self.span.add(lines=1, bytes=len(line))
+            yield line
+        self.wait()
+
+    def wait(self):
+        if self.returncode is None:
+            self.process.stdout.close()
+            self.returncode = self.process.wait()
+            if self._timer is not None:
+                self._timer.cancel()
+            self.span.duration = time.time() - self.span.start
+            self.span.set(returncode=self.returncode, timed_out=self.timed_out)
+            tracer.record(self.span)
+        return self.returncode
+
+    def output(self):
+        return ''.join(self.lines())
+
+
+def run(cmd, timeout=None):
+    """
+    runs cmd, returns tuple of (exit code, output), exit code is None if the command timed out
+    """
+    with Command(cmd, timeout) as command:
+        output = command.output()
+    return (None if command.timed_out else command.returncode), output
+
+def run_many(cmds, timeout=None, workers=4):
+    """
+    runs several commands at once, returns list of (exit code, output) in the order of cmds
+    """
+    if not cmds:
+        return []
+    pool = ThreadPool(min(workers, len(cmds)))
+    try:
+        return pool.map(lambda cmd: run(cmd, timeout), cmds)
+    finally:
+        pool.close()
+        pool.join()
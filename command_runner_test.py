@@ -0,0 +1,40 @@
+import time
+import unittest
+from command_runner import Command, run, run_many
+
+__author__ = 'jakub.zygmunt'
+
+class CommandRunnerTest(unittest.TestCase):
+
+    def testShouldStreamAllLinesAndExitCode(self):
+        expectedList = ['first\n', 'second\n', 'last line without newline']
+        with Command(['sh', '-c', 'echo first; echo second; printf "last line without newline"; exit 3']) as command:
+            lines = [x for x in command.lines()]
+        self.assertEqual(expectedList, lines)
+        self.assertEqual(3, command.returncode)
+        self.assertFalse(command.timed_out)
+
+    def testShouldKillCommandOnTimeout(self):
+        started = time.time()
+        returncode, output = run(['sh', '-c', 'echo started; sleep 30; echo finished'], timeout=0.5)
+        self.assertTrue(time.time() - started < 10)
+        self.assertEqual(None, returncode)
+        self.assertEqual('started\n', output)
+
+    def testStoppingEarlyShouldNotCountAsTimeout(self):
+        with Command(['sh', '-c', 'echo started; sleep 30'], timeout=20) as command:
+            command.lines().next()
+        self.assertNotEqual(0, command.returncode)
+        self.assertFalse(command.timed_out)
+
+    def testShouldRunCommandsConcurrently(self):
+        cmds = [['sh', '-c', 'sleep 0.5; echo %s' % x] for x in range(4)]
+        started = time.time()
+        results = run_many(cmds, workers=4)
+        self.assertTrue(time.time() - started < 1.5)
+        self.assertEqual([(0, '%s\n' % x) for x in range(4)], results)
+
+    def testSplunkStubOutputShouldNotLoseLines(self):
+        returncode, output = run(['test_files/test_splunk.sh', 'list', 'user', '-auth', 'user:user'])
+        self.assertEqual(0, returncode)
+        self.assertTrue('username:\twigywigy\n' in output)
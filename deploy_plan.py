@@ -0,0 +1,64 @@
+import difflib
+import os
+
+__author__ = 'jakub.zygmunt'
+
+class DeployPlan(object):
+    """
+    changes deploying a client would make, computed in memory without touching
+    the disk or splunk, the rendered files are kept so applying the plan doesn't render again
+    """
+
+    def __init__(self, client, data, app_folder):
+        self.client = client
+        self.data = data
+        self.app_folder = app_folder
+        self.clone_url = None
+        self.files = []
+        # False when the templates couldn't be read before cloning, applying renders them after the clone
+        self.files_known = True
+        self.role = None
+        self.role_text = None
+        self.user = None
+        self.user_role = None
+        # create or update when splunk was queried, ensure when it couldn't be checked without forking splunk
+        self.user_action = None
+
+    def addFile(self, filename, content, current=None):
+        if current is None:
+            status = 'create'
+        elif current == content:
+            status = 'unchanged'
+        else:
+            status = 'change'
+        self.files.append({ 'filename': filename, 'content': content, 'current': current, 'status': status })
+
+    def changedFiles(self):
+        return [f for f in self.files if f['status'] != 'unchanged']
+
+    def hasChanges(self):
+        return bool(self.clone_url or self.changedFiles() or self.role or self.user_action in ('create', 'update'))
+
+    def diff(self, file):
+        current = (file['current'] or '').splitlines(True)
+        rendered = file['content'].splitlines(True)
+        name = os.path.relpath(file['filename'], self.app_folder)
+        return ''.join(difflib.unified_diff(current, rendered, 'a/' + name, 'b/' + name))
+
+    def format(self, diffs=True):
+        lines = ['Client %s' % self.client]
+        if self.clone_url:
+            lines.append('  clone %s -> %s' % (self.clone_url, self.app_folder))
+        if not self.files_known:
+            lines.append('  files unknown, the templates are rendered after cloning (set app_skeleton to list them)')
+        for file in self.changedFiles():
+            lines.append('  %s %s' % (file['status'], os.path.relpath(file['filename'], self.app_folder)))
+            if diffs and file['status'] == 'change':
+                lines.extend('    ' + line for line in self.diff(file).splitlines())
+        if self.role:
+            lines.append('  add role %s' % self.role)
+        if self.user_action:
+            lines.append('  %s user %s (role %s)' % (self.user_action, self.user, self.user_role))
+        if not self.hasChanges():
+            lines.append('  no changes')
+        return '\n'.join(lines) + '\n'
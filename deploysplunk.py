@@ -1,11 +1,31 @@
-import subprocess
 import os
 import sys
 import ConfigParser
 import re
+import hashlib
+import binascii
+import json
+import threading
 import fnmatch
-from cirrus_cmdb import CirrusCmdb
-from jinja2 import Template
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from cirrus_cmdb import CirrusCmdb, CmdbUnavailableException
+from cmdb_cache import ResponseCache
+from cmdb_records import Record
+from cmdb_snapshot import CmdbSnapshot
+from atomic_file import atomic_open, atomic_write
+from authorize_conf import AuthorizeConf
+from command_runner import Command, run_many
+from deploy_plan import DeployPlan
+from reload_scheduler import ReloadScheduler, conf_type
+from timing import tracer, profile
+from splunk_backend import SplunkCliBackend, SplunkRestBackend, SplunkAuthException, SplunkUnavailableException, \
+    UserIndex
+from template_engine import TemplateEngine
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 __author__ = 'jakub.zygmunt'
 
@@ -20,6 +40,21 @@ class Struct:
 
 class DeploySplunk(object):
     splunk_bin = '/opt/splunk/bin/splunk'
+    authorize_conf = '/opt/splunk/etc/system/local/authorize.conf'
+    userrole_template = 'templates/userrole.template'
+    template_engine = TemplateEngine()
+    command_timeout = 600
+    deploy_workers = 8
+    render_workers = 4
+    manifest_name = '.deploysplunk.manifest'
+    # directory and file name globs skipped when looking for templates, extended by template_ignore in the config
+    template_ignore = ('.git',)
+    gitignore_begin = '# BEGIN deploysplunk generated files\n'
+    gitignore_end = '# END deploysplunk generated files\n'
+    _caches = {}
+    _cache_lock = threading.Lock()
+    _render_pool = None
+    _template_lists = {}
 
     def __init__(self, config=None, file=None, out=sys.stdout, user=None, password=None):
         self.out = out
@@ -31,11 +66,70 @@ class DeploySplunk(object):
             self.readConfigFile(file)
 
         self.is_connected = False
+        self._splunk_backend = None
+        self._reload_scheduler = None
 
         if self.config:
             self.cmdb = CirrusCmdb(base_api_url=self.config.base_url, user=self.config.user,
-                password=self.config.password)
-            self.is_connected = self.cmdb.can_connect()
+                password=self.config.password, page_workers=int(getattr(self.config, 'page_workers', 1)),
+                cache=self.getCmdbCache(), snapshot=self.getCmdbSnapshot(),
+                pool_size=int(getattr(self.config, 'cmdb_pool_size', 10)),
+                records=getattr(self.config, 'cmdb_records', 'false').lower() == 'true')
+            self.is_connected = self.cmdb.can_connect() or self.hasSnapshot()
+
+    def getCmdbCache(self):
+        """
+        cmdb response cache configured with cache_ttl, cache_size and cache_file, shared by all
+        instances using the same cache settings
+        """
+        if not hasattr(self.config, 'cache_ttl'):
+            return None
+        key = (self.config.cache_ttl, getattr(self.config, 'cache_size', 1024), getattr(self.config, 'cache_file', None))
+        with DeploySplunk._cache_lock:
+            if key not in DeploySplunk._caches:
+                DeploySplunk._caches[key] = ResponseCache(ttl=float(key[0]), max_size=int(key[1]), filename=key[2])
+            return DeploySplunk._caches[key]
+
+    def getCmdbSnapshot(self):
+        """
+        local cmdb replica stored in snapshot_file and used while younger than snapshot_max_age seconds,
+        shared by all instances using the same file
+        """
+        if not hasattr(self.config, 'snapshot_file'):
+            return None
+        key = ('snapshot', self.config.snapshot_file)
+        with DeploySplunk._cache_lock:
+            if key not in DeploySplunk._caches:
+                DeploySplunk._caches[key] = CmdbSnapshot(self.config.snapshot_file,
+                    max_age=float(getattr(self.config, 'snapshot_max_age', 3600)))
+            return DeploySplunk._caches[key]
+
+    def hasSnapshot(self):
+        """
+        True if customers are in the snapshot, so clients can be deployed while the cmdb is down
+        """
+        snapshot = self.getCmdbSnapshot()
+        return snapshot is not None and snapshot.age('customers') is not None
+
+    def syncSnapshot(self):
+        """
+        brings the snapshot up to date with the cmdb, keeps the old snapshot if the cmdb is unavailable
+        """
+        if self.getCmdbSnapshot() is None:
+            return None
+        try:
+            with tracer.span('cmdb.snapshot.sync'):
+                return self.cmdb.sync_snapshot()
+        except CmdbUnavailableException, err:
+            self.log('Cannot sync cmdb snapshot, using the old one: %s' % err)
+            return None
+
+    def close(self):
+        """
+        stops the cmdb page workers
+        """
+        if self.config:
+            self.cmdb.close()
 
     def log(self, msg):
         self.out.write(msg)
@@ -46,18 +140,18 @@ class DeploySplunk(object):
     def getClientAppName(self, client_name):
         return client_name.replace(' ','').lower()
 
+    def getCommandTimeout(self):
+        return float(getattr(self.config, 'command_timeout', self.command_timeout))
+
     def __run(self, cmd):
         """
-        returns generator of output lines given by cmd
+        returns generator of output lines given by cmd, the command is killed after command_timeout seconds
         """
-
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        while(True):
-            retcode = p.poll()
-            line = p.stdout.readline()
-            yield line
-            if(retcode is not None):
-                break
+        with Command(cmd, timeout=self.getCommandTimeout()) as command:
+            for line in command.lines():
+                yield line
+        if command.timed_out:
+            self.log('Command timed out: %s' % ' '.join(cmd[:2]))
 
     def __runCommand(self, cmd, return_list=False):
         """
@@ -67,6 +161,12 @@ class DeploySplunk(object):
         output = outputList if return_list else ''.join(outputList)
         return output
 
+    def runCommands(self, cmds, workers=4):
+        """
+        runs several commands at once, returns list of (exit code, output), exit code is None on timeout
+        """
+        return run_many(cmds, timeout=self.getCommandTimeout(), workers=workers)
+
     def readConfigFile(self, file):
         parser = ConfigParser.SafeConfigParser()
         parser.read(file)
@@ -82,14 +182,47 @@ class DeploySplunk(object):
             aws_accounts = self.cmdb.get_all_aws_account_numbers(client)
         return aws_accounts
 
-    def cloneAppFromGithub(self, folder, client_name):
+    def updateAppMirror(self):
+        """
+        creates or fetches the local bare mirror (mirror_dir) of github_url, returns its path or None
+        the mirror is never pruned (automatic gc is off), so objects used by the shared client checkouts stay available
+        """
+        mirror = getattr(self.config, 'mirror_dir', None)
+        if not mirror or not getattr(self.config, 'github_url', ''):
+            return None
+        fetch = os.path.exists(mirror)
+        if not fetch:
+            self.__runCommand(['git', 'clone', '--quiet', '--mirror', self.config.github_url, mirror])
+            if not os.path.exists(mirror):
+                return None
+        # set on every update so mirrors created by older versions are protected before their next fetch
+        for key, value in [('gc.auto', '0'), ('gc.pruneExpire', 'never')]:
+            self.__runCommand(['git', '--git-dir', mirror, 'config', key, value])
+        if fetch:
+            self.__runCommand(['git', '--git-dir', mirror, 'fetch', '--quiet', 'origin'])
+        return mirror
+
+    def cloneAppFromGithub(self, folder, client_name, refresh_mirror=True):
+        """
+        clones the app repository into folder + client_name, returns the new folder or None
+        with mirror_dir configured the clone is a cheap local checkout sharing the mirror's objects,
+        refresh_mirror=False skips fetching the mirror (done once per batch by deployMany)
+        """
         if folder is not None and os.path.exists(folder):
             if hasattr(self.config, 'github_url') and self.config.github_url is not '':
                 newfolder = folder +client_name
-                self.__runCommand(['git','clone', self.config.github_url, newfolder])
+                mirror = getattr(self.config, 'mirror_dir', None)
+                if refresh_mirror:
+                    mirror = self.updateAppMirror()
+                with tracer.span('git.clone', client=client_name, mirror=bool(mirror)):
+                    if mirror and os.path.exists(mirror):
+                        self.__runCommand(['git', 'clone', '--quiet', '--shared', mirror, newfolder])
+                        self.__runCommand(['git', '-C', newfolder, 'remote', 'set-url', 'origin', self.config.github_url])
+                    else:
+                        self.__runCommand(['git','clone', self.config.github_url, newfolder])
 
                 if os.path.exists(newfolder):
-                    pass
+                    return newfolder
                 else:
                     self.log('Cannot clone the repository')
 
@@ -99,64 +232,620 @@ class DeploySplunk(object):
             self.log('App directory not found')
 
     def parseTemplate(self, filename, data):
-        fr=open(filename,'r')
-        inputSource = fr.read()
-        template = Template(inputSource).render(data)
-        newfilename = re.sub('\.template$', '', filename)
-        with open(newfilename, 'w') as fw:
-            fw.write(template)
+        """
+        renders filename into the same path without .template, returns hash of the output
+        the output is streamed into a temporary file hashed on the way and renamed over the old one,
+        so memory stays flat for large confs and splunk never reads a half-written file
+        """
+        with tracer.span('template.render', file=filename) as span:
+            newfilename = re.sub('\.template$', '', filename)
+            output_hash = hashlib.sha1()
+            size = 0
+            with atomic_open(newfilename) as fw:
+                for chunk in self.template_engine.stream(filename, data):
+                    chunk = chunk.encode('utf-8')
+                    fw.write(chunk)
+                    output_hash.update(chunk)
+                    size += len(chunk)
+            span.add(bytes=size)
+        return output_hash.hexdigest()
 
-    def getTemplateFiles(self, folder):
+    def hashData(self, data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True,
+            default=lambda value: value.to_dict() if isinstance(value, Record) else str(value))).hexdigest()
+
+    def hashFile(self, filename):
+        if not os.path.exists(filename):
+            return None
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def readManifest(self, folder):
+        try:
+            with open(os.path.join(folder, self.manifest_name), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def writeManifest(self, folder, manifest):
+        atomic_write(os.path.join(folder, self.manifest_name), json.dumps(manifest, sort_keys=True, indent=1))
+
+    def isTemplateUpToDate(self, entry, template_hash, data_hash, output_file):
+        """
+        template, data and output on disk are all the same as when the manifest entry was written
+        """
+        return entry is not None and entry.get('template') == template_hash and entry.get('data') == data_hash \
+            and entry.get('output') == self.hashFile(output_file)
+
+    def getTemplateIgnore(self):
+        extra = getattr(self.config, 'template_ignore', '')
+        return tuple(self.template_ignore) + tuple(p.strip() for p in extra.split(',') if p.strip())
+
+    def listDirectory(self, folder):
+        """
+        list of (name, is directory) of the entries of folder, symlinks aren't followed,
+        with scandir installed the entry types come from the directory listing without a stat per entry
+        """
+        if scandir is not None:
+            return [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(folder)]
+        entries = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            entries.append((name, os.path.isdir(path) and not os.path.islink(path)))
+        return entries
+
+    def findTemplates(self, folder, ignore):
         matches = []
-        for root, dirnames, filenames in os.walk(folder):
-            for filename in fnmatch.filter(filenames, '*.template'):
-                matches.append(os.path.join(root, filename))
+        for name, is_directory in sorted(self.listDirectory(folder)):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in ignore):
+                continue
+            path = os.path.join(folder, name)
+            if is_directory:
+                matches.extend(self.findTemplates(path, ignore))
+            elif name.endswith('.template'):
+                matches.append(path)
         return matches
 
-    def convertAllTemplates(self, folder, data):
+    def getRevision(self, folder):
+        """
+        commit checked out in folder as read from .git/HEAD, None if folder isn't a git clone
+        """
+        git_dir = os.path.join(folder, '.git')
+        try:
+            with open(os.path.join(git_dir, 'HEAD')) as f:
+                head = f.read().strip()
+            if not head.startswith('ref: '):
+                return head
+            ref = head[len('ref: '):]
+            if os.path.isfile(os.path.join(git_dir, ref)):
+                with open(os.path.join(git_dir, ref)) as f:
+                    return f.read().strip()
+            with open(os.path.join(git_dir, 'packed-refs')) as f:
+                for line in f:
+                    if line.rstrip().endswith(' ' + ref):
+                        return line.split()[0]
+        except IOError:
+            pass
+        return None
+
+    def getTemplateFiles(self, folder):
+        """
+        sorted list of templates in folder, skipping template_ignore globs, clones of the same
+        app skeleton revision reuse the list found in the first one instead of walking the tree again
+        """
+        ignore = self.getTemplateIgnore()
+        revision = self.getRevision(folder)
+        if revision is None:
+            return self.findTemplates(folder, ignore)
+
+        key = (revision, ignore)
+        with DeploySplunk._cache_lock:
+            templates = DeploySplunk._template_lists.get(key)
+        if templates is None:
+            templates = [os.path.relpath(f, folder) for f in self.findTemplates(folder, ignore)]
+            with DeploySplunk._cache_lock:
+                DeploySplunk._template_lists[key] = templates
+        return [os.path.join(folder, f) for f in templates]
+
+    def getRenderPool(self):
+        """
+        thread pool rendering templates, created once and shared by all instances
+        as starting and joining a pool for every client costs more than rendering its templates
+        """
+        with DeploySplunk._cache_lock:
+            if DeploySplunk._render_pool is None:
+                DeploySplunk._render_pool = ThreadPool(self.render_workers)
+            return DeploySplunk._render_pool
+
+    def convertAllTemplates(self, folder, data, incremental=False):
+        """
+        renders all templates in folder, in incremental mode only the ones whose template,
+        data or output changed since the last run (as recorded in the folder's manifest),
+        several templates are rendered on the shared pool of render_workers threads (see getRenderPool)
+        returns dictionary with lists of rendered and skipped templates
+        """
         templates = self.getTemplateFiles(folder)
-        for file in templates:
-            self.parseTemplate(file, data)
-        self.updateGitIgnore(folder, templates)
+        to_render = templates
+        if incremental:
+            manifest = self.readManifest(folder)
+            data_hash = self.hashData(data)
+            template_hashes = {}
+            to_render = []
+            for file in templates:
+                key = os.path.relpath(file, folder)
+                template_hashes[key] = hashlib.sha1(self.template_engine.readSource(file)).hexdigest()
+                if not self.isTemplateUpToDate(manifest.get(key), template_hashes[key], data_hash,
+                                               re.sub('\.template$', '', file)):
+                    to_render.append(file)
 
+        if self.render_workers > 1 and len(to_render) > 1:
+            output_hashes = self.getRenderPool().map(lambda file: self.parseTemplate(file, data), to_render)
+        else:
+            output_hashes = [self.parseTemplate(file, data) for file in to_render]
+
+        extra_files = []
+        if incremental:
+            for file, output_hash in zip(to_render, output_hashes):
+                key = os.path.relpath(file, folder)
+                manifest[key] = { 'template': template_hashes[key], 'data': data_hash, 'output': output_hash }
+            self.writeManifest(folder, dict((k, v) for k, v in manifest.items() if k in template_hashes))
+            extra_files.append(os.path.join(folder, self.manifest_name))
+        self.updateGitIgnore(folder, templates, extra_files)
+        self.getReloadScheduler().touchFiles(re.sub('\.template$', '', f) for f in to_render)
+
+        return { 'rendered': to_render, 'skipped': [f for f in templates if f not in to_render] }
+
+
+    def updateGitIgnore(self, folder, templateFiles, extraFiles=()):
+        """
+        keeps the generated files in a managed, de-duplicated block of folder/.gitignore,
+        the file is rewritten atomically and only when its content changes
+        """
+        filename = '%s/.gitignore' % folder
+        try:
+            with open(filename, 'r') as f:
+                original = f.read()
+        except IOError:
+            original = ''
+
+        outside = []
+        entries = []
+        inside = False
+        for line in original.splitlines(True):
+            if line == self.gitignore_begin:
+                inside = True
+            elif line == self.gitignore_end:
+                inside = False
+            elif inside:
+                entries.append(line.rstrip('\n'))
+            else:
+                outside.append(line)
 
-    def updateGitIgnore(self, folder, templateFiles):
-        files = [ re.sub('\.template$', '',f) for f in templateFiles ]
-        with open('%s/.gitignore' % folder, 'a') as f:
-           for filename in files:
-               f.write('%s\n' % filename)
+        files = [ re.sub('\.template$', '',f) for f in templateFiles ] + list(extraFiles)
+        generated = sorted(set(e for e in entries + files if e))
+        known = set(generated)
+
+        # lines appended by older versions are moved into the managed block
+        outside = [line for line in outside if line.rstrip('\n') not in known]
+        if outside and not outside[-1].endswith('\n'):
+            outside[-1] += '\n'
+
+        content = ''.join(outside) + self.gitignore_begin + ''.join('%s\n' % e for e in generated) + self.gitignore_end
+        if content != original:
+            atomic_write(filename, content)
 
     def isUserRoleAlreadyDefined(self, conf_file, role):
-        parser=ConfigParser.SafeConfigParser()
-        parser.read(conf_file)
-        return role in parser.sections()
+        return AuthorizeConf(conf_file).hasRole(role)
 
+    def addUserRoles(self, conf_file, data_list, replace=False):
+        """
+        adds (or with replace, updates) the roles of many clients reading and writing conf_file once
+        returns list of clients whose role changed
+        """
+        with tracer.span('authorize.roles', file=conf_file) as span:
+            conf = AuthorizeConf(conf_file)
+            changed = []
+            for data in data_list:
+                user_role = 'role_client-%s' % data['client']
+                user_role_template = self.template_engine.render(self.userrole_template, data)
+                if conf.setRole(user_role, user_role_template, replace=replace):
+                    changed.append(data['client'])
+            conf.save()
+            span.add(roles=len(data_list), changed=len(changed))
+        if changed:
+            self.getReloadScheduler().touch(conf_type(conf_file))
+        return changed
 
     def addUserRole(self, conf_file, data):
-        user_role = 'role_client-%s' % data['client']
-        if not self.isUserRoleAlreadyDefined(conf_file, user_role):
-            fr=open('templates/userrole.template','r')
-            inputSource = fr.read()
-            user_role_template = Template(inputSource).render(data)
-            with open(conf_file, 'a') as fw :
-                fw.write(user_role_template)
+        return len(self.addUserRoles(conf_file, [data])) > 0
 
-    def addUser(self, data):
+    def getSplunkBackend(self):
+        """
+        splunkd REST backend when splunk_api_url is configured and reachable, splunk CLI otherwise
+        """
+        if self._splunk_backend is None:
+            api_url = getattr(self.config, 'splunk_api_url', None)
+            if api_url:
+                rest = SplunkRestBackend(api_url, self.user, self.password,
+                    ignore_ssl=getattr(self.config, 'splunk_ignore_ssl', 'false').lower() == 'true')
+                try:
+                    rest.login()
+                    self._splunk_backend = rest
+                except SplunkAuthException:
+                    self._splunk_backend = rest
+                except SplunkUnavailableException:
+                    pass
+            if self._splunk_backend is None:
+                self._splunk_backend = SplunkCliBackend(self.splunk_bin, self.user, self.password,
+                    timeout=self.getCommandTimeout())
+        return self._splunk_backend
+
+    def getReloadScheduler(self):
+        """
+        splunk reloads collected during the run, flushed after splunk_reload_interval seconds
+        when it's configured and at the end of every deploy
+        """
+        if self._reload_scheduler is None:
+            interval = None
+            if getattr(self.config, 'splunk_reload', 'true').lower() != 'false':
+                interval = float(getattr(self.config, 'splunk_reload_interval', 0)) or None
+            self._reload_scheduler = ReloadScheduler(self.getSplunkBackend, interval=interval, log=self.log)
+        return self._reload_scheduler
+
+    def flushReloads(self, conf_types=None):
+        """
+        reloads what the run changed in splunk with as few reloads as possible (or one restart),
+        only the changed conf_types when given, unless splunk_reload is false in the config
+        """
+        if getattr(self.config, 'splunk_reload', 'true').lower() == 'false':
+            return None
+        with tracer.span('splunk.reload') as span:
+            result = self.getReloadScheduler().flush(conf_types)
+            span.add(reloads=len(result['reloaded']), restarts=int(result['restarted']), failed=len(result['failed']))
+        return result
+
+    def reloadRoles(self):
+        """
+        reloads changed roles right away, splunkd rejects users with roles it hasn't loaded yet
+        """
+        return self.flushReloads(['authorize'])
+
+    def getClientUser(self, data):
+        """
+        splunk user and role of a client, the role is defined in authorize.conf as role_client-<client>
+        """
+        return data['client'], 'client-%s' % data['client']
+
+    def generatePassword(self):
+        return binascii.hexlify(os.urandom(12))
+
+    def provisionUsers(self, data_list):
+        """
+        creates missing client users (and adds missing client roles) listing the splunk users only once,
+        a user splunk rejects is logged and skipped,
+        returns dictionary of created users and their generated passwords
+        """
+        backend = self.getSplunkBackend()
+        index = UserIndex(backend.listUsers())
+        created = {}
+        for data in data_list:
+            username, role = self.getClientUser(data)
+            try:
+                if username not in index:
+                    password = self.generatePassword()
+                    backend.addUser(username, password, [role])
+                    index.add(username, [role])
+                    created[username] = password
+                elif role not in index.roles(username):
+                    backend.editUser(username, sorted(index.roles(username) | set([role])))
+                    index.add(username, [role])
+            except (SplunkAuthException, SplunkUnavailableException), err:
+                self.log('Cannot add splunk user %s: %s' % (username, err))
+        return created
+
+    def savePasswords(self, created):
+        """
+        appends the generated passwords to password_file (readable by its owner only) when it's configured
+        """
+        filename = getattr(self.config, 'password_file', None)
+        if not filename or not created:
+            return
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+            os.fchmod(fd, 0600)
+            with os.fdopen(fd, 'a') as f:
+                for username, password in sorted(created.items()):
+                    f.write('%s %s\n' % (username, password))
+        except (IOError, OSError), err:
+            self.log('Cannot save splunk user passwords: %s' % err)
+
+    def addUsers(self, data_list):
+        """
+        creates the missing client users, returns dictionary of created users and their passwords,
+        which are also saved to password_file
+        """
         if self.user and self.password:
-            failedString = 'Unauthorized\n'
-            output = self.__runCommand([self.splunk_bin, 'list', 'user', '-auth', '%s:%s' % (self.user, self.password) ],
-                return_list=True)
-            if failedString in output:
+            try:
+                created = self.provisionUsers(data_list)
+                self.savePasswords(created)
+                return created
+            except SplunkAuthException:
                 self.log("wrong username or password.")
+            except SplunkUnavailableException:
+                self.log("Cannot connect to splunk.")
         else:
             self.log("no authentication credentials found.")
+        return {}
+
+    def addUser(self, data):
+        """
+        adds the client user, returns the generated password of a created user or None
+        """
+        username, role = self.getClientUser(data)
+        password = self.addUsers([data]).get(username)
+        if password is not None:
+            self.log('Created splunk user %s.' % username)
+        return password
+
 
+    def getAuthorizeConf(self):
+        return getattr(self.config, 'authorize_conf', self.authorize_conf)
 
-    def deploy(self, clientName):
+    def deployClient(self, clientName, batch=False, aws_accounts=None):
+        """
+        runs the whole pipeline for a single client, returns the template data
+        of the deployed client or None
+        in batch mode the role and user are left to the caller, to be added for the whole batch,
+        aws_accounts already resolved by the caller save the cmdb lookups
+        """
+        app_name = self.getClientAppName(clientName)
+        if aws_accounts is None:
+            aws_accounts = self.getAmazonAccounts(clientName)
+        data = { 'client': app_name,
+                 'aws_accounts': aws_accounts or [] }
+        app_home = getattr(self.config, 'app_home', None)
+        new_app = app_home is not None and not os.path.exists(app_home + app_name)
+        app_folder = self.cloneAppFromGithub(app_home, app_name, refresh_mirror=not batch)
+        if app_folder is None:
+            return None
+        if new_app:
+            self.getReloadScheduler().touch('app')
+        incremental = getattr(self.config, 'incremental', 'false').lower() == 'true'
+        report = self.convertAllTemplates(app_folder, data, incremental=incremental)
+        if report['skipped']:
+            self.log('Skipped %d unchanged templates.' % len(report['skipped']))
+        if not batch:
+            self.addUserRole(self.getAuthorizeConf(), data)
+            self.reloadRoles()
+            self.addUser(data)
+            self.flushReloads()
+        return data
+
+    def deploy(self, clientName, batch=False, aws_accounts=None):
         if self.config:
             if self.is_connected:
-                pass
+                with tracer.span('deploy.client', client=clientName):
+                    return self.deployClient(clientName, batch, aws_accounts)
             else:
                 self.log('Cannot connect to cmdb.')
         else:
             self.log('No config found')
+        return None
+
+    def planClient(self, clientName):
+        """
+        renders the templates and role of a client in memory and compares them with the disk,
+        nothing is written and splunk is only asked for its users through the REST backend
+        """
+        app_name = self.getClientAppName(clientName)
+        data = { 'client': app_name,
+                 'aws_accounts': self.getAmazonAccounts(clientName) or [] }
+        app_folder = (getattr(self.config, 'app_home', None) or '') + app_name
+        plan = DeployPlan(app_name, data, app_folder)
+
+        source = app_folder
+        if not os.path.exists(app_folder):
+            plan.clone_url = getattr(self.config, 'github_url', None)
+            source = getattr(self.config, 'app_skeleton', None)
+        if not source or not os.path.exists(source):
+            plan.files_known = False
+        else:
+            for template in self.getTemplateFiles(source):
+                filename = os.path.join(app_folder, re.sub('\.template$', '', os.path.relpath(template, source)))
+                current = None
+                if os.path.exists(filename):
+                    with open(filename, 'r') as f:
+                        current = f.read()
+                plan.addFile(filename, self.template_engine.render(template, data).encode('utf-8'), current)
+
+        user_role = 'role_client-%s' % app_name
+        if not self.isUserRoleAlreadyDefined(self.getAuthorizeConf(), user_role):
+            plan.role = user_role
+            plan.role_text = self.template_engine.render(self.userrole_template, data)
+
+        plan.user, plan.user_role = self.getClientUser(data)
+        plan.user_action = 'ensure'
+        backend = self.getSplunkBackend() if self.user and self.password else None
+        if isinstance(backend, SplunkRestBackend):
+            try:
+                index = UserIndex(backend.listUsers())
+                if plan.user not in index:
+                    plan.user_action = 'create'
+                elif plan.user_role not in index.roles(plan.user):
+                    plan.user_action = 'update'
+                else:
+                    plan.user_action = None
+            except (SplunkAuthException, SplunkUnavailableException):
+                pass
+        return plan
+
+    def plan(self, clientName):
+        """
+        prints and returns the changes deploying the client would make, see planClient
+        """
+        if not self.config:
+            self.log('No config found')
+            return None
+        plan = self.planClient(clientName)
+        self.log(plan.format())
+        return plan
+
+    def applyPlan(self, plan):
+        """
+        deploys a client writing the files already rendered by planClient,
+        the templates of a fresh clone planned without an app_skeleton are rendered after cloning
+        """
+        if plan.clone_url:
+            app_home = getattr(self.config, 'app_home', None)
+            if self.cloneAppFromGithub(app_home, plan.client) is None:
+                return None
+            self.getReloadScheduler().touch('app')
+            if not plan.files_known:
+                self.convertAllTemplates(plan.app_folder, plan.data)
+        for file in plan.changedFiles():
+            atomic_write(file['filename'], file['content'])
+            self.getReloadScheduler().touch(conf_type(file['filename']))
+        if plan.files:
+            self.updateGitIgnore(plan.app_folder, [], [f['filename'] for f in plan.files])
+        if plan.role:
+            conf = AuthorizeConf(self.getAuthorizeConf())
+            conf.setRole(plan.role, plan.role_text)
+            conf.save()
+            self.getReloadScheduler().touch(conf_type(self.getAuthorizeConf()))
+        if plan.user_action:
+            self.reloadRoles()
+            self.addUser(plan.data)
+        self.flushReloads()
+        return plan.data
+
+    def profileClient(self, clientName, filename):
+        """
+        deploys a single client under cProfile, the stats are written to filename (see pstats)
+        """
+        return profile(filename, self.deploy, clientName)
+
+    def timingReport(self):
+        """
+        time spent per stage (cmdb pages and queries, git, templates, roles, commands) since tracer.start(),
+        deployMany starts the tracer itself when trace_file is configured
+        """
+        return tracer.report()
+
+    def exportTrace(self, filename):
+        tracer.exportJsonLines(filename)
+
+    def getAllClientNames(self):
+        customers = self.cmdb.get_all_customers() if self.is_connected else None
+        return [c['name'] for c in customers or []]
+
+    def getAmazonAccountsByClient(self, clientNames):
+        """
+        aws accounts of many clients resolved with a few batched cmdb queries,
+        empty dictionary if the cmdb can't be reached so clients are looked up one by one
+        """
+        if not self.is_connected:
+            return {}
+        try:
+            with tracer.span('cmdb.accounts.bulk', clients=len(clientNames)):
+                return self.cmdb.get_aws_accounts_by_customer_names(clientNames)
+        except CmdbUnavailableException, err:
+            self.log('Cannot resolve aws accounts in bulk: %s' % err)
+            return {}
+
+    def _deployIsolated(self, clientName, aws_accounts=None):
+        """
+        deploys one client with its own cmdb connection and output buffer,
+        so a slow client doesn't share state with the other workers
+        """
+        result = { 'client': clientName, 'status': 'failed', 'output': '', 'error': None, 'data': None }
+        out = StringIO()
+        ds = None
+        try:
+            ds = DeploySplunk(config=self.config, out=out, user=self.user, password=self.password)
+            ds.splunk_bin = self.splunk_bin
+            ds._splunk_backend = self.getSplunkBackend()
+            ds._reload_scheduler = self.getReloadScheduler()
+            result['data'] = ds.deploy(clientName, batch=True, aws_accounts=aws_accounts)
+            if result['data'] is not None:
+                result['status'] = 'ok'
+        except Exception, err:
+            result['error'] = str(err)
+        finally:
+            if ds is not None:
+                ds.close()
+        result['output'] = out.getvalue()
+        return result
+
+    def deployMany(self, clientNames=None, workers=None):
+        """
+        deploys a batch of clients (all cmdb customers if clientNames is None)
+        on a bounded thread pool, roles of all deployed clients are then added
+        to authorize.conf in one pass, their users created listing splunk users once
+        and splunk reloaded once for everything the batch changed,
+        returns a dictionary of per-client results
+        """
+        if not self.config:
+            self.log('No config found')
+            return {}
+        if clientNames is None:
+            clientNames = self.getAllClientNames()
+        if not clientNames:
+            return {}
+
+        trace_file = getattr(self.config, 'trace_file', None)
+        if trace_file:
+            tracer.start()
+        try:
+            results = self._deployBatch(clientNames, workers)
+        finally:
+            if trace_file:
+                tracer.stop()
+                self.exportTrace(trace_file)
+        return dict((r['client'], r) for r in results)
+
+    def _deployBatch(self, clientNames, workers=None):
+        """
+        the steps of deployMany, errors adding the roles and users of the batch are logged and
+        recorded in the results of the deployed clients instead of losing the results
+        """
+        self.syncSnapshot()
+        accounts = self.getAmazonAccountsByClient(clientNames)
+        self.updateAppMirror()
+        # created before the workers start, so they share one backend (and splunk login) and one scheduler
+        self.getSplunkBackend()
+        self.getReloadScheduler()
+        pool = ThreadPool(min(workers or self.deploy_workers, len(clientNames)))
+        try:
+            results = pool.map(lambda name: self._deployIsolated(name, accounts.get(name)), clientNames, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        deployed = [r['data'] for r in results if r['status'] == 'ok']
+        added_roles = set()
+        created_users = {}
+        errors = []
+        if deployed:
+            try:
+                added_roles = set(self.addUserRoles(self.getAuthorizeConf(), deployed))
+                self.reloadRoles()
+                created_users = self.addUsers(deployed)
+            except (IOError, OSError, SplunkAuthException, SplunkUnavailableException), err:
+                errors.append('Cannot add roles and users: %s' % err)
+        try:
+            self.flushReloads()
+        except (IOError, OSError), err:
+            errors.append('Cannot reload splunk: %s' % err)
+
+        for error in errors:
+            self.log(error)
+        for r in results:
+            client = r['data']['client'] if r['data'] is not None else None
+            r['role_added'] = client in added_roles
+            r['user_password'] = created_users.get(client)
+            if r['status'] == 'ok' and errors:
+                r['error'] = '; '.join(errors)
+        return results
@@ -1,12 +1,23 @@
 from StringIO import StringIO
 import os
 import shutil
+import subprocess
+import tempfile
 import unittest
 import ConfigParser
 import fnmatch
 import re
-from deploysplunk import DeploySplunk
+from deploysplunk import DeploySplunk, Struct
+from timing import tracer
+from cmdb_records import AwsAccount
+import json
+import pstats
 import logging
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files'))
+from splunkd_stub import SplunkdStub
+from cmdb_stub import CmdbStub, synthetic_collections
 
 __author__ = 'jakub.zygmunt'
 
@@ -42,6 +53,8 @@ class DeploySplunkTest(unittest.TestCase):
 
     def cleanConfFiles(self):
         matches = self.getFiles(folder = 'test_files', filter='*.conf')
+        matches += self.getFiles(folder = 'test_files', filter='local.meta')
+        matches += self.getFiles(folder = 'test_files', filter=DeploySplunk.manifest_name)
         for file in matches:
             os.remove(file)
 
@@ -321,7 +334,366 @@ sourcetype = some_sourcetype'''
         output = self.getOutput()
         self.assertEqual(expectedString, output)
 
+    def testDeployManyWithoutConfigShouldReturnEmptySummary(self):
+        expectedString = 'No config found'
+        ds = DeploySplunk(out=self.out)
+        results = ds.deployMany(['client1', 'client2'])
+        self.assertEqual({}, results)
+        self.assertEqual(expectedString, self.getOutput())
 
+    def testDeployManyShouldReturnResultPerClient(self):
+        config = {  'base_url': 'http://completelywrong.dns.name.to.be.sure.it.wont.work',
+                    'user': 'a',
+                    'password': 'b',
+        }
+        clients = ['client1', 'client2', 'client3']
+        ds = DeploySplunk(config=config, out=self.out)
+        results = ds.deployMany(clients, workers=2)
+        self.assertEqual(sorted(clients), sorted(results.keys()))
+        for client in clients:
+            self.assertEqual('failed', results[client]['status'])
+            self.assertEqual('Cannot connect to cmdb.', results[client]['output'])
+        self.assertEqual('', self.getOutput())
+
+    def testRecordsShouldRenderAndHashLikeDictionaries(self):
+        accounts = [ { 'id': 1, 'number': '1111-2222-3333' }, { 'id': 2, 'number': '2222-3333-4444' } ]
+        records = [ AwsAccount.from_dict(a) for a in accounts ]
+        ds = DeploySplunk(out=self.out)
+        template = ds.template_engine.load('test_files/local/inputs.conf.template')
+        self.assertEqual(template.render({ 'client': 'wigywigy', 'aws_accounts': accounts }),
+                         template.render({ 'client': 'wigywigy', 'aws_accounts': records }))
+        self.assertEqual(ds.hashData({ 'aws_accounts': [ r.to_dict() for r in records ] }),
+                         ds.hashData({ 'aws_accounts': records }))
+
+    def testParseTemplateShouldStreamIntoPlaceAtomically(self):
+        folder = tempfile.mkdtemp()
+        try:
+            template_file = os.path.join(folder, 'inputs.conf.template')
+            shutil.copyfile('test_files/local/inputs.conf.template', template_file)
+            data = { 'client': 'wigywigy', 'aws_accounts': [ { 'number': '%012d' % a } for a in range(5000) ] }
+            ds = DeploySplunk(out=self.out)
+            expected = ds.template_engine.render(template_file, data)
+            output_hash = ds.parseTemplate(template_file, data)
+            self.assertEqual(expected, open(os.path.join(folder, 'inputs.conf')).read())
+            self.assertEqual(ds.hashFile(os.path.join(folder, 'inputs.conf')), output_hash)
+
+            def fail():
+                raise ValueError('broken data')
+            with open(template_file, 'a') as f:
+                f.write('{{ fail() }}')
+            data['fail'] = fail
+            self.assertRaises(ValueError, ds.parseTemplate, template_file, data)
+            self.assertEqual(expected, open(os.path.join(folder, 'inputs.conf')).read())
+            self.assertEqual(['inputs.conf', 'inputs.conf.template'], sorted(os.listdir(folder)))
+        finally:
+            shutil.rmtree(folder)
+
+    def testTemplateEngineShouldCompileSameSourceOnce(self):
+        ds = DeploySplunk(out=self.out)
+        first = ds.template_engine.load('test_files/local/savedsearches.conf.template')
+        source = open('test_files/local/savedsearches.conf.template').read()
+        self.assertTrue(first is ds.template_engine.fromSource(source))
+        self.assertEqual(first.render({ 'client': 'wigywigy' }),
+                         ds.template_engine.fromSource(source).render({ 'client': 'wigywigy' }))
 
+    def testIncrementalConvertShouldSkipUnchangedTemplates(self):
+        data = { 'client' : 'wigywigy',
+                 'aws_accounts' : [ { 'number': '1111-2222-3333'} , { 'number': '2222-3333-4444'} ]
+        }
+        app_folder = 'test_files'
+        ds = DeploySplunk(out=self.out)
+        first = ds.convertAllTemplates(app_folder, data, incremental=True)
+        second = ds.convertAllTemplates(app_folder, data, incremental=True)
+        self.assertEqual(3, len(first['rendered']))
+        self.assertEqual([], second['rendered'])
+        self.assertEqual(first['rendered'], second['skipped'])
+
+        os.remove('test_files/metadata/local.meta')
+        data['aws_accounts'].append({ 'number': '3333-4444-5555' })
+        third = ds.convertAllTemplates(app_folder, data, incremental=True)
+        self.assertEqual(3, len(third['rendered']))
+        self.assertTrue(os.path.exists('test_files/metadata/local.meta'))
+
+        os.remove('test_files/metadata/local.meta')
+        fourth = ds.convertAllTemplates(app_folder, data, incremental=True)
+        self.assertEqual(['test_files/metadata/local.meta.template'], fourth['rendered'])
+
+    def testGitIgnoreShouldNotGrowOnRedeploy(self):
+        expectedString = '''# this line shouldn't be removed
+# BEGIN deploysplunk generated files
+test_files/local/inputs.conf
+test_files/local/savedsearches.conf
+test_files/metadata/local.meta
+# END deploysplunk generated files
+'''
+        with open('test_files/.gitignore', 'a') as f:
+            f.write('test_files/local/inputs.conf\n')
+        data = { 'client' : 'wigywigy', 'aws_accounts' : [] }
+        app_folder = 'test_files'
+        ds = DeploySplunk(out=self.out)
+        ds.convertAllTemplates(app_folder, data)
+        os.utime('test_files/.gitignore', (0, 0))
+        ds.convertAllTemplates(app_folder, data)
+        self.assertEqual(expectedString, open('test_files/.gitignore').read())
+        self.assertEqual(0, os.stat('test_files/.gitignore').st_mtime)
 
+    def testShouldAddManyUserRolesInOnePass(self):
+        app_folder = 'test_files'
+        conf_file = '%s/authorize.with-role.conf' % app_folder
+        original = open(conf_file).read()
+        ds = DeploySplunk(out=self.out)
+        added = ds.addUserRoles(conf_file, [ { 'client': 'wigywigy' }, { 'client': 'client1' }, { 'client': 'client2' } ])
+        self.assertEqual(['client1', 'client2'], added)
+        content = open(conf_file).read()
+        self.assertTrue(content.startswith(original))
+        parser = self.loadConfigFile(conf_file)
+        self.assertEqual(['role_can_delete', 'role_client-wigywigy', 'role_client-client1', 'role_client-client2'],
+                         parser.sections())
+        self.assertEqual('client-client2', parser.get('role_client-client2', 'srchIndexesDefault'))
 
+    def testShouldReplaceUserRoleKeepingOtherRoles(self):
+        app_folder = 'test_files'
+        conf_file = '%s/authorize.with-role.conf' % app_folder
+        ds = DeploySplunk(out=self.out)
+        added = ds.addUserRoles(conf_file, [ { 'client': 'wigywigy' } ], replace=True)
+        self.assertEqual(['wigywigy'], added)
+        content = open(conf_file).read()
+        self.assertTrue(content.startswith(open('test_files/authorize.with-role.generator').read().split('[role_client')[0]))
+        parser = self.loadConfigFile(conf_file)
+        self.assertEqual('20', parser.get('role_client-wigywigy', 'rtSrchJobsQuota'))
+
+    def createAppRepository(self, folder):
+        repo = os.path.join(folder, 'app')
+        os.makedirs(os.path.join(repo, 'local'))
+        shutil.copyfile('test_files/local/savedsearches.conf.template', os.path.join(repo, 'local/savedsearches.conf.template'))
+        for cmd in [ ['git', 'init', '-q'], ['git', 'add', '.'],
+                     ['git', '-c', 'user.name=test', '-c', 'user.email=test@test', 'commit', '-q', '-m', 'app'] ]:
+            subprocess.check_call(cmd, cwd=repo)
+        return 'file://' + repo
+
+    def testShouldCloneClientsFromLocalMirror(self):
+        folder = tempfile.mkdtemp()
+        try:
+            config = { 'github_url': self.createAppRepository(folder),
+                       'mirror_dir': os.path.join(folder, 'mirror.git') }
+            ds = DeploySplunk(out=self.out)
+            ds.config = Struct(**config)
+            app_home = folder + '/'
+            self.assertEqual(app_home + 'client1', ds.cloneAppFromGithub(app_home, 'client1'))
+            self.assertEqual(app_home + 'client2', ds.cloneAppFromGithub(app_home, 'client2', refresh_mirror=False))
+            for client in ['client1', 'client2']:
+                self.assertTrue(os.path.exists(os.path.join(folder, client, 'local/savedsearches.conf.template')))
+                self.assertTrue(os.path.exists(os.path.join(folder, client, '.git/objects/info/alternates')))
+                origin = subprocess.check_output(['git', 'config', 'remote.origin.url'], cwd=os.path.join(folder, client))
+                self.assertEqual(config['github_url'], origin.strip())
+            for key, value in [('gc.auto', '0'), ('gc.pruneExpire', 'never')]:
+                self.assertEqual(value, subprocess.check_output(['git', '--git-dir', config['mirror_dir'], 'config', key]).strip())
+            self.assertEqual('', self.getOutput())
+        finally:
+            shutil.rmtree(folder)
+
+    def testDeployClientShouldReloadRolesBeforeAddingUser(self):
+        folder = tempfile.mkdtemp()
+        splunkd = SplunkdStub().start()
+        try:
+            conf_file = os.path.join(folder, 'authorize.conf')
+            shutil.copyfile('test_files/authorize.no-role.generator', conf_file)
+            splunkd.authorize_conf = conf_file
+            ds = DeploySplunk(out=self.out, user='admin', password='changeme')
+            ds.config = Struct(github_url=self.createAppRepository(folder), app_home=folder + '/',
+                               authorize_conf=conf_file, splunk_api_url=splunkd.url)
+            data = ds.deployClient('WigyWigy', aws_accounts=[])
+            self.assertEqual('wigywigy', data['client'])
+            self.assertEqual(['client-wigywigy'], splunkd.users['wigywigy'])
+            self.assertTrue(splunkd.requests.index(('POST', '/services/authorization/roles/_reload')) <
+                            splunkd.requests.index(('POST', '/services/authentication/users')))
+            self.assertEqual(['authorization/roles', 'apps/local', 'saved/searches'], splunkd.reloads)
+            self.assertEqual('Created splunk user wigywigy.', self.getOutput())
+        finally:
+            splunkd.stop()
+            shutil.rmtree(folder)
+
+    def testDeployManyShouldDeployEveryCmdbClient(self):
+        folder = tempfile.mkdtemp()
+        cmdb = CmdbStub(synthetic_collections(customers=3, accounts=2, instances=0, security_groups=0)).start()
+        splunkd = SplunkdStub().start()
+        try:
+            app_home = folder + '/'
+            conf_file = os.path.join(folder, 'authorize.conf')
+            shutil.copyfile('test_files/authorize.no-role.generator', conf_file)
+            splunkd.authorize_conf = conf_file
+            config = { 'base_url': cmdb.url, 'user': 'a', 'password': 'b', 'app_home': app_home,
+                       'github_url': self.createAppRepository(folder), 'mirror_dir': os.path.join(folder, 'mirror.git'),
+                       'authorize_conf': conf_file, 'splunk_api_url': splunkd.url }
+            ds = DeploySplunk(config=config, out=self.out, user='admin', password='changeme')
+            results = ds.deployMany(workers=3)
+            ds.close()
+
+            clients = ['customer1', 'customer2', 'customer3']
+            self.assertEqual(['Customer 1', 'Customer 2', 'Customer 3'], sorted(results.keys()))
+            for name, result in sorted(results.items()):
+                client = ds.getClientAppName(name)
+                self.assertEqual('ok', result['status'])
+                self.assertEqual(client, result['data']['client'])
+                self.assertEqual(2, len(result['data']['aws_accounts']))
+                self.assertTrue(result['role_added'])
+                self.assertEqual(24, len(result['user_password']))
+                self.assertEqual(['client-%s' % client], splunkd.users[client])
+                self.assertTrue(os.path.exists(os.path.join(app_home, client, 'local/savedsearches.conf')))
+                self.assertTrue(os.path.exists(os.path.join(app_home, client, '.git/objects/info/alternates')))
+            self.assertEqual(1, len([r for r in cmdb.requestsFor('aws_accounts') if 'page=' not in r]))
+            parser = self.loadConfigFile(conf_file)
+            self.assertEqual(['role_client-%s' % c for c in clients],
+                             sorted(s for s in parser.sections() if s.startswith('role_client-')))
+            self.assertEqual(1, splunkd.requests.count(('GET', '/services/authentication/users')))
+            self.assertEqual(['authorization/roles', 'apps/local', 'saved/searches'], splunkd.reloads)
+            self.assertEqual(1, splunkd.logins)
+            self.assertEqual('', self.getOutput())
+        finally:
+            splunkd.stop()
+            cmdb.stop()
+            shutil.rmtree(folder)
+
+    def testDeployManyShouldKeepResultsWhenRolesCannotBeWritten(self):
+        folder = tempfile.mkdtemp()
+        cmdb = CmdbStub(synthetic_collections(customers=2, accounts=1, instances=0, security_groups=0)).start()
+        try:
+            config = { 'base_url': cmdb.url, 'user': 'a', 'password': 'b', 'app_home': folder + '/',
+                       'github_url': self.createAppRepository(folder), 'splunk_reload': 'false',
+                       'authorize_conf': os.path.join(folder, 'missing/authorize.conf'),
+                       'trace_file': os.path.join(folder, 'trace.jsonl') }
+            ds = DeploySplunk(config=config, out=self.out)
+            results = ds.deployMany(workers=2)
+            ds.close()
+            self.assertEqual(['Customer 1', 'Customer 2'], sorted(results.keys()))
+            for result in results.values():
+                self.assertEqual('ok', result['status'])
+                self.assertFalse(result['role_added'])
+                self.assertTrue(result['error'].startswith('Cannot add roles and users: '))
+            self.assertTrue(self.getOutput().startswith('Cannot add roles and users: '))
+            self.assertTrue(os.path.exists(config['trace_file']))
+        finally:
+            cmdb.stop()
+            shutil.rmtree(folder)
+
+    def testTemplateDiscoveryShouldPruneAndCachePerRevision(self):
+        folder = tempfile.mkdtemp()
+        try:
+            repo = self.createAppRepository(folder)[len('file://'):]
+            os.makedirs(os.path.join(repo, 'lookups'))
+            open(os.path.join(repo, 'lookups/big.csv.template'), 'w').close()
+            open(os.path.join(repo, '.git/stray.template'), 'w').close()
+            ds = DeploySplunk(out=self.out)
+            ds.template_ignore = ('.git', 'lookups')
+            expectedList = [ os.path.join(repo, 'local/savedsearches.conf.template') ]
+            self.assertEqual(expectedList, ds.getTemplateFiles(repo))
+
+            open(os.path.join(repo, 'local/inputs.conf.template'), 'w').close()
+            self.assertEqual(expectedList, ds.getTemplateFiles(repo))
+            subprocess.check_call(['git', 'add', '.'], cwd=repo)
+            subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@test', 'commit', '-q', '-m', 'inputs'], cwd=repo)
+            self.assertEqual([ os.path.join(repo, 'local/inputs.conf.template') ] + expectedList, ds.getTemplateFiles(repo))
+        finally:
+            shutil.rmtree(folder)
+
+    def testPlanShouldNotWriteAndApplyShouldReuseRenderedFiles(self):
+        folder = tempfile.mkdtemp()
+        try:
+            app_folder = os.path.join(folder, 'wigywigy')
+            shutil.copytree('test_files', app_folder)
+            with open(os.path.join(app_folder, 'local/savedsearches.conf'), 'w') as f:
+                f.write('[instanceReservationExpiryRecommendation]\n')
+            conf_file = os.path.join(folder, 'authorize.conf')
+            shutil.copyfile('test_files/authorize.no-role.generator', conf_file)
+            ds = DeploySplunk(out=self.out)
+            ds.config = Struct(app_home=folder + '/', authorize_conf=conf_file)
+
+            plan = ds.plan('WigyWigy')
+            self.assertEqual(['create', 'change', 'create'], [f['status'] for f in sorted(plan.files, key=lambda f: f['filename'])])
+            self.assertEqual('role_client-wigywigy', plan.role)
+            self.assertFalse(os.path.exists(os.path.join(app_folder, 'local/inputs.conf')))
+            self.assertFalse(ds.isUserRoleAlreadyDefined(conf_file, 'role_client-wigywigy'))
+            output = self.getOutput()
+            self.assertTrue('  change local/savedsearches.conf' in output)
+            self.assertTrue('    +search = index="wigywigy" test test | other text index-wigywigy' in output)
+
+            ds.template_engine = None
+            ds.user = None
+            ds.applyPlan(plan)
+            self.assertTrue(os.path.exists(os.path.join(app_folder, 'local/inputs.conf')))
+            self.assertTrue(ds.isUserRoleAlreadyDefined(conf_file, 'role_client-wigywigy'))
+            ds = DeploySplunk(out=self.out)
+            ds.config = Struct(app_home=folder + '/', authorize_conf=conf_file)
+            self.assertEqual([], ds.planClient('WigyWigy').changedFiles())
+        finally:
+            shutil.rmtree(folder)
+
+    def testPlanShouldCompareNonAsciiOutputWithDisk(self):
+        folder = tempfile.mkdtemp()
+        try:
+            app_folder = os.path.join(folder, 'wigywigy')
+            shutil.copytree('test_files', app_folder)
+            conf_file = os.path.join(folder, 'authorize.conf')
+            shutil.copyfile('test_files/authorize.no-role.generator', conf_file)
+            accounts = [ { 'number': u'caf\xe9' } ]
+            ds = DeploySplunk(out=self.out)
+            ds.config = Struct(app_home=folder + '/', authorize_conf=conf_file)
+            ds.getAmazonAccounts = lambda client=None: accounts
+            ds.convertAllTemplates(app_folder, { 'client': 'wigywigy', 'aws_accounts': accounts })
+            self.assertEqual([], ds.planClient('WigyWigy').changedFiles())
+
+            with open(os.path.join(app_folder, 'local/inputs.conf'), 'w') as f:
+                f.write('[script://old]\n')
+            ds.user = None
+            ds.applyPlan(ds.planClient('WigyWigy'))
+            self.assertTrue('caf\xc3\xa9' in open(os.path.join(app_folder, 'local/inputs.conf')).read())
+            self.assertEqual([], ds.planClient('WigyWigy').changedFiles())
+        finally:
+            shutil.rmtree(folder)
+
+    def testApplyPlanShouldRenderFreshCloneWithoutSkeleton(self):
+        folder = tempfile.mkdtemp()
+        try:
+            conf_file = os.path.join(folder, 'authorize.conf')
+            shutil.copyfile('test_files/authorize.no-role.generator', conf_file)
+            ds = DeploySplunk(out=self.out)
+            ds.config = Struct(github_url=self.createAppRepository(folder), app_home=folder + '/', authorize_conf=conf_file)
+            plan = ds.plan('WigyWigy')
+            self.assertEqual([], plan.files)
+            self.assertTrue('  files unknown, the templates are rendered after cloning' in self.getOutput())
+
+            ds.user = None
+            ds.applyPlan(plan)
+            self.assertTrue(os.path.exists(os.path.join(folder, 'wigywigy/local/savedsearches.conf')))
+        finally:
+            shutil.rmtree(folder)
+
+    def testShouldRecordTimingSpansAndExportTrace(self):
+        data = { 'client' : 'wigywigy', 'aws_accounts' : [] }
+        ds = DeploySplunk(out=self.out)
+        ds.convertAllTemplates('test_files', data)
+        tracer.start()
+        try:
+            ds.convertAllTemplates('test_files', data)
+            ds.addUserRole('test_files/authorize.no-role.conf', data)
+        finally:
+            tracer.stop()
+        ds.addUserRole('test_files/authorize.with-role.conf', data)
+        summary = tracer.summary()
+        self.assertEqual(3, summary['template.render']['calls'])
+        self.assertTrue(summary['template.render']['bytes'] > 0)
+        self.assertEqual(1, summary['authorize.roles']['changed'])
+        self.assertTrue('template.render' in ds.timingReport())
+
+        trace_file = 'output/trace.jsonl'
+        ds.exportTrace(trace_file)
+        records = [json.loads(line) for line in open(trace_file)]
+        self.assertEqual(4, len(records))
+        self.assertEqual('authorize.roles', records[-1]['name'])
+
+    def testShouldProfileSingleClientDeploy(self):
+        expectedString = 'No config found'
+        ds = DeploySplunk(out=self.out)
+        ds.profileClient('wigywigy', 'output/deploy.prof')
+        self.assertEqual(expectedString, self.getOutput())
+        self.assertTrue(pstats.Stats('output/deploy.prof').total_calls > 0)
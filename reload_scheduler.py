@@ -0,0 +1,124 @@
+import os
+import threading
+from splunk_backend import SplunkAuthException, SplunkUnavailableException
+
+__author__ = 'jakub.zygmunt'
+
+def conf_type(filename):
+    """
+    splunk conf type of a generated file (inputs for local/inputs.conf, meta for local.meta),
+    None for files splunk doesn't need to reload
+    """
+    name = os.path.basename(filename)
+    if name.endswith('.conf'):
+        return name[:-len('.conf')]
+    if name.endswith('.meta'):
+        return 'meta'
+    return None
+
+
+class ReloadScheduler(object):
+    """
+    records the splunk conf types touched during a run and, on flush, reloads every affected
+    splunkd endpoint once, or restarts splunk once if a touched conf type can't be reloaded,
+    with interval set touches are flushed that many seconds after the first unflushed one
+    """
+    # conf type -> splunkd endpoints picking it up on services/<endpoint>/_reload, other conf types need a restart
+    reload_targets = { 'app': ['apps/local'],
+                       'meta': ['apps/local'],
+                       'authorize': ['authorization/roles'],
+                       'savedsearches': ['saved/searches'],
+                       'inputs': ['data/inputs/script', 'data/inputs/monitor'],
+                       'props': ['admin/props-extract'],
+                       'transforms': ['admin/transforms-extract'],
+                       'macros': ['admin/macros'],
+                       'eventtypes': ['saved/eventtypes'],
+                       'tags': ['saved/fvtags'] }
+
+    def __init__(self, get_backend, interval=None, log=None):
+        self.get_backend = get_backend
+        self.interval = interval
+        self.log = log
+        self.touched = set()
+        self.reloads = 0
+        self.restarts = 0
+        self._targets = set()
+        self._restart = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def touch(self, conf_type):
+        if conf_type is None:
+            return
+        with self._lock:
+            self.touched.add(conf_type)
+            if conf_type in self.reload_targets:
+                self._targets.update(self.reload_targets[conf_type])
+            else:
+                self._restart = True
+            if self.interval and self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def touchFiles(self, filenames):
+        for filename in filenames:
+            self.touch(conf_type(filename))
+
+    def pending(self):
+        """
+        tuple of (sorted endpoints to reload, restart needed)
+        """
+        with self._lock:
+            return sorted(self._targets), self._restart
+
+    def flush(self, conf_types=None):
+        """
+        issues the pending reloads or restart, endpoints that failed to reload stay pending,
+        with conf_types only the pending endpoints of those conf types are reloaded and the rest stays pending,
+        returns dictionary of reloaded endpoints, restarted flag and failed endpoints
+        """
+        with self._lock:
+            if conf_types is not None:
+                endpoints = set(e for t in conf_types for e in self.reload_targets.get(t, []))
+                targets, restart = sorted(self._targets & endpoints), False
+                self._targets -= endpoints
+            else:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                targets, restart = sorted(self._targets), self._restart
+                self._targets = set()
+                self._restart = False
+
+        result = { 'reloaded': [], 'restarted': False, 'failed': [] }
+        if not targets and not restart:
+            return result
+        try:
+            backend = self.get_backend()
+            if restart:
+                backend.restart()
+                result['restarted'] = True
+                self.restarts += 1
+                return result
+        except (SplunkAuthException, SplunkUnavailableException, OSError), err:
+            self._failed(targets, restart, err)
+            result['failed'] = targets
+            return result
+
+        for target in targets:
+            try:
+                backend.reload(target)
+                result['reloaded'].append(target)
+                self.reloads += 1
+            except (SplunkAuthException, SplunkUnavailableException, OSError), err:
+                self._failed([target], False, err)
+                result['failed'].append(target)
+        return result
+
+    def _failed(self, targets, restart, err):
+        with self._lock:
+            self._targets.update(targets)
+            self._restart = self._restart or restart
+        if self.log is not None:
+            self.log('Cannot reload splunk %s: %s' % ('(restart)' if restart else ', '.join(targets), err))
@@ -0,0 +1,242 @@
+import json
+import re
+import socket
+import threading
+import urllib
+import httplib2
+from command_runner import Command, run
+
+__author__ = 'jakub.zygmunt'
+
+class SplunkAuthException(Exception):
+    def __init__(self, value=None):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
+
+class SplunkUnavailableException(Exception):
+    def __init__(self, value=None):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
+
+
+def parse_users(lines):
+    """
+    streams user records out of `splunk list user` output (username:, full-name: and role: lines),
+    yields dictionaries of username and roles
+    """
+    user = None
+    for line in lines:
+        key, separator, value = line.partition(':')
+        key = key.strip()
+        if key == 'username':
+            if user is not None:
+                yield user
+            user = { 'username': value.strip(), 'roles': [] }
+        elif key == 'role' and user is not None:
+            user['roles'].append(value.strip())
+    if user is not None:
+        yield user
+
+
+class UserIndex(object):
+    """
+    splunk users fetched once and indexed by username
+    """
+
+    def __init__(self, users):
+        self.users = {}
+        for user in users:
+            self.add(user['username'], user['roles'])
+
+    def __contains__(self, username):
+        return username in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def add(self, username, roles):
+        self.users.setdefault(username, set()).update(roles)
+
+    def roles(self, username):
+        return self.users.get(username, set())
+
+
+class SplunkCliBackend(object):
+    """
+    manages splunk by forking the splunk command line, every call authenticates again
+    """
+    failed_string = 'Unauthorized\n'
+    status_re = re.compile(r'^HTTPStatus: (\d+)', re.M)
+
+    def __init__(self, splunk_bin, user, password, timeout=None):
+        self.splunk_bin = splunk_bin
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+
+    def _run(self, args):
+        """
+        runs a splunk command, raises SplunkAuthException when the login is rejected and
+        SplunkUnavailableException when it times out or exits with an error
+        """
+        name = ' '.join(args[:2])
+        returncode, output = run([self.splunk_bin] + args + ['-auth', '%s:%s' % (self.user, self.password)],
+            timeout=self.timeout)
+        if returncode is None:
+            raise SplunkUnavailableException('splunk %s timed out' % name)
+        if self.failed_string in output.splitlines(True):
+            raise SplunkAuthException('login failed for %s' % self.user)
+        if returncode != 0:
+            raise SplunkUnavailableException('splunk %s failed with exit code %s - %s' % (name, returncode, output.strip()))
+        return output
+
+    def checkCredentials(self):
+        try:
+            self._run(['list', 'user'])
+        except SplunkAuthException:
+            return False
+        return True
+
+    def listUsers(self):
+        """
+        generator of users parsed while `splunk list user` is still printing them
+        """
+        cmd = [self.splunk_bin, 'list', 'user', '-auth', '%s:%s' % (self.user, self.password)]
+        with Command(cmd, timeout=self.timeout) as command:
+            for user in parse_users(self._checkAuthorized(command.lines())):
+                yield user
+        if command.timed_out:
+            raise SplunkUnavailableException('splunk list user timed out')
+        if command.returncode != 0:
+            raise SplunkUnavailableException('splunk list user failed with exit code %s' % command.returncode)
+
+    def _checkAuthorized(self, lines):
+        for line in lines:
+            if line == self.failed_string:
+                raise SplunkAuthException('login failed for %s' % self.user)
+            yield line
+
+    def addUser(self, name, password, roles):
+        self._run(['add', 'user', name, '-password', password] + self._roleArgs(roles))
+
+    def editUser(self, name, roles):
+        self._run(['edit', 'user', name] + self._roleArgs(roles))
+
+    def _roleArgs(self, roles):
+        args = []
+        for role in roles:
+            args += ['-role', role]
+        return args
+
+    def reload(self, target):
+        """
+        reloads a splunkd endpoint, the same targets as SplunkRestBackend.reload (authorization/roles...)
+        """
+        endpoint = '/services/%s/_reload' % target.strip('/')
+        output = self._run(['_internal', 'call', endpoint, '-method', 'POST'])
+        status = self.status_re.search(output)
+        if status is None or not 200 <= int(status.group(1)) < 300:
+            raise SplunkUnavailableException('splunk _internal call %s - %s' % (endpoint, output.strip()))
+
+    def restart(self):
+        returncode, output = run([self.splunk_bin, 'restart'], timeout=self.timeout)
+        if returncode != 0:
+            raise SplunkUnavailableException('splunk restart %s - %s' % (
+                'timed out' if returncode is None else 'failed with exit code %s' % returncode, output.strip()))
+
+
+class SplunkRestBackend(object):
+    """
+    manages splunk through the splunkd management REST api, using one keep-alive
+    connection authenticated once with a session key
+    """
+
+    def __init__(self, base_url, user, password, ignore_ssl=False, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.user = user
+        self.password = password
+        self._http = httplib2.Http(disable_ssl_certificate_validation=ignore_ssl, timeout=timeout)
+        self._session_key = None
+        self._lock = threading.Lock()
+
+    def _request(self, path, method='GET', params=None, headers=None):
+        url = self.base_url + path
+        body = None
+        headers = dict(headers or {})
+        if method == 'GET':
+            url += ('&' if '?' in url else '?') + urllib.urlencode(list(params or []) + [('output_mode', 'json')])
+        else:
+            body = urllib.urlencode(list(params or []) + [('output_mode', 'json')])
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            with self._lock:
+                response, content = self._http.request(url, method, body=body, headers=headers)
+        except (socket.error, httplib2.ServerNotFoundError), err:
+            raise SplunkUnavailableException('%s - %s' % (url, err))
+        return response, content
+
+    def login(self):
+        response, content = self._request('/services/auth/login', 'POST',
+            [('username', self.user), ('password', self.password)])
+        if response.status != 200:
+            raise SplunkAuthException('login failed for %s' % self.user)
+        self._session_key = json.loads(content)['sessionKey']
+        return self._session_key
+
+    def request(self, path, method='GET', params=None):
+        """
+        authenticated request, logs in again once if the session key has expired
+        returns decoded json response
+        """
+        for attempt in range(2):
+            if self._session_key is None:
+                self.login()
+            response, content = self._request(path, method, params,
+                { 'Authorization': 'Splunk %s' % self._session_key })
+            if response.status == 401:
+                self._session_key = None
+                continue
+            if response.status >= 400:
+                raise SplunkUnavailableException('%s %s - http %s' % (method, path, response.status))
+            return json.loads(content) if content else {}
+        raise SplunkAuthException('session rejected for %s' % self.user)
+
+    def checkCredentials(self):
+        if self._session_key is not None:
+            return True
+        try:
+            self.login()
+        except SplunkAuthException:
+            return False
+        return True
+
+    def _entries(self, path):
+        return self.request(path, params=[('count', 0)]).get('entry', [])
+
+    def listUsers(self):
+        return [{ 'username': e['name'], 'roles': e['content'].get('roles', []) }
+                for e in self._entries('/services/authentication/users')]
+
+    def addUser(self, name, password, roles):
+        self.request('/services/authentication/users', 'POST',
+            [('name', name), ('password', password)] + [('roles', role) for role in roles])
+
+    def editUser(self, name, roles):
+        self.request('/services/authentication/users/%s' % urllib.quote(name), 'POST',
+            [('roles', role) for role in roles])
+
+    def listRoles(self):
+        return [e['name'] for e in self._entries('/services/authorization/roles')]
+
+    def listApps(self):
+        return [e['name'] for e in self._entries('/services/apps/local')]
+
+    def reload(self, target):
+        self.request('/services/%s/_reload' % target.strip('/'), 'POST')
+
+    def restart(self):
+        self.request('/services/server/control/restart', 'POST')
@@ -0,0 +1,162 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+from deploysplunk import DeploySplunk
+from splunk_backend import SplunkRestBackend, SplunkCliBackend, SplunkAuthException, SplunkUnavailableException, \
+    parse_users
+from reload_scheduler import ReloadScheduler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files'))
+from splunkd_stub import SplunkdStub
+
+__author__ = 'jakub.zygmunt'
+
+class SplunkBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.out = StringIO()
+        self.splunkd = SplunkdStub().start()
+
+    def tearDown(self):
+        self.splunkd.stop()
+
+    def getOutput(self):
+        return self.out.getvalue().strip()
+
+    def getConfig(self, splunk_api_url):
+        return {  'base_url': 'http://completelywrong.dns.name.to.be.sure.it.wont.work',
+                  'user': 'a',
+                  'password': 'b',
+                  'splunk_api_url': splunk_api_url,
+        }
+
+    def testRestBackendShouldLoginOnceAndReuseSession(self):
+        backend = SplunkRestBackend(self.splunkd.url, 'admin', 'changeme')
+        self.assertTrue(backend.checkCredentials())
+        self.splunkd.roles.append('client-wigywigy')
+        backend.addUser('wigywigy', 'secret', ['client-wigywigy'])
+        users = backend.listUsers()
+        self.assertTrue({ 'username': 'wigywigy', 'roles': ['client-wigywigy'] } in users)
+        self.assertEqual(['admin', 'power', 'user', 'client-wigywigy'], backend.listRoles())
+        backend.reload('authorization/roles')
+        self.assertEqual(['authorization/roles'], self.splunkd.reloads)
+        self.assertEqual(1, self.splunkd.logins)
+
+    def testRestBackendShouldRejectWrongPassword(self):
+        backend = SplunkRestBackend(self.splunkd.url, 'admin', 'nopassword')
+        self.assertFalse(backend.checkCredentials())
+        self.assertRaises(SplunkAuthException, backend.listUsers)
+
+    def testShouldUseRestBackendWhenConfigured(self):
+        expectedString = 'wrong username or password.'
+        ds = DeploySplunk(config=self.getConfig(self.splunkd.url), out=self.out, user='admin', password='nopassword')
+        ds.addUser({ 'client': 'wigywigy' })
+        self.assertTrue(isinstance(ds.getSplunkBackend(), SplunkRestBackend))
+        self.assertEqual(expectedString, self.getOutput())
+
+    def testShouldFallBackToCliWhenSplunkdIsDown(self):
+        expectedString = 'wrong username or password.'
+        ds = DeploySplunk(config=self.getConfig('http://127.0.0.1:1'), out=self.out, user='user', password='nopassword')
+        ds.splunk_bin = 'test_files/test_splunk.sh'
+        ds.addUser({ 'client': 'wigywigy' })
+        self.assertTrue(isinstance(ds.getSplunkBackend(), SplunkCliBackend))
+        self.assertEqual(expectedString, self.getOutput())
+
+    def testDeployManyWorkersShouldShareOneSplunkLogin(self):
+        ds = DeploySplunk(config=self.getConfig(self.splunkd.url), out=self.out, user='admin', password='changeme')
+        results = ds.deployMany(['client%s' % i for i in range(8)], workers=8)
+        self.assertEqual(8, len(results))
+        self.assertEqual(1, self.splunkd.logins)
+
+    def testReloadSchedulerShouldReloadEachEndpointOnce(self):
+        ds = DeploySplunk(config=self.getConfig(self.splunkd.url), out=self.out, user='admin', password='changeme')
+        scheduler = ds.getReloadScheduler()
+        for client in ['client1', 'client2', 'client3']:
+            scheduler.touchFiles(['%s/local/inputs.conf' % client, '%s/local/savedsearches.conf' % client,
+                                  '%s/metadata/local.meta' % client, '%s/bin/script.py' % client])
+            scheduler.touch('authorize')
+        result = ds.flushReloads()
+        expectedList = ['apps/local', 'authorization/roles', 'data/inputs/monitor', 'data/inputs/script', 'saved/searches']
+        self.assertEqual(expectedList, result['reloaded'])
+        self.assertEqual(expectedList, self.splunkd.reloads)
+        self.assertEqual(0, self.splunkd.restarts)
+        self.assertEqual([], ds.flushReloads()['reloaded'])
+        self.assertEqual('', self.getOutput())
+
+    def testReloadSchedulerShouldRestartOnceForUnreloadableConf(self):
+        backend = SplunkRestBackend(self.splunkd.url, 'admin', 'changeme')
+        scheduler = ReloadScheduler(lambda: backend, interval=0.05)
+        scheduler.touchFiles(['client1/local/inputs.conf', 'client1/local/indexes.conf', 'client2/local/indexes.conf'])
+        for i in range(100):
+            if self.splunkd.restarts:
+                break
+            time.sleep(0.02)
+        self.assertEqual(1, self.splunkd.restarts)
+        self.assertEqual([], self.splunkd.reloads)
+        self.assertEqual(([], False), scheduler.pending())
+
+    def testCliBackendShouldReloadThroughSplunkd(self):
+        backend = SplunkCliBackend('test_files/test_splunk.sh', 'user', 'user')
+        scheduler = ReloadScheduler(lambda: backend)
+        scheduler.touch('authorize')
+        self.assertEqual(['authorization/roles'], scheduler.flush()['reloaded'])
+
+    def testCliBackendShouldRaiseOnFailedCommands(self):
+        backend = SplunkCliBackend('test_files/test_splunk.sh', 'user', 'user')
+        backend.addUser('wigywigy', 'secret', ['client-wigywigy'])
+        self.assertRaises(SplunkUnavailableException, backend.addUser, 'broken', 'secret', ['client-broken'])
+        self.assertRaises(SplunkUnavailableException, backend.editUser, 'broken', ['client-broken'])
+        self.assertRaises(SplunkUnavailableException, backend.reload, 'missing/endpoint')
+        backend.restart()
+        self.assertFalse(SplunkCliBackend('test_files/test_splunk.sh', 'user', 'nopassword').checkCredentials())
+
+    def testShouldParseSplunkUserListing(self):
+        lines = iter(['username:\tuser\n', 'full-name:\tuser\n', 'role:\tuser\n', '\n',
+                      'username:\twigywigy\n', 'full-name:\twigywigy\n', 'role:\tclient-wigywigy\n', 'role:\tuser\n'])
+        users = list(parse_users(lines))
+        self.assertEqual([ { 'username': 'user', 'roles': ['user'] },
+                           { 'username': 'wigywigy', 'roles': ['client-wigywigy', 'user'] } ], users)
+
+    def testCliBackendShouldListUsers(self):
+        backend = SplunkCliBackend('test_files/test_splunk.sh', 'user', 'user')
+        self.assertEqual(['user', 'wigywigy'], [u['username'] for u in backend.listUsers()])
+        backend = SplunkCliBackend('test_files/test_splunk.sh', 'user', 'nopassword')
+        self.assertRaises(SplunkAuthException, list, backend.listUsers())
+        backend = SplunkCliBackend('test_files/test_splunk.sh', 'down', 'down')
+        self.assertRaises(SplunkUnavailableException, list, backend.listUsers())
+
+    def testShouldKeepCreatedUsersWhenOneUserFails(self):
+        ds = DeploySplunk(config=self.getConfig('http://127.0.0.1:1'), out=self.out, user='user', password='user')
+        ds.splunk_bin = 'test_files/test_splunk.sh'
+        created = ds.addUsers([ { 'client': 'broken' }, { 'client': 'client1' } ])
+        self.assertEqual(['client1'], created.keys())
+        self.assertTrue(self.getOutput().startswith('Cannot add splunk user broken:'))
+
+    def testShouldSavePasswordsOfCreatedUsersPrivately(self):
+        self.splunkd.roles.append('client-client1')
+        folder = tempfile.mkdtemp()
+        try:
+            config = self.getConfig(self.splunkd.url)
+            config['password_file'] = os.path.join(folder, 'passwords')
+            ds = DeploySplunk(config=config, out=self.out, user='admin', password='changeme')
+            password = ds.addUser({ 'client': 'client1' })
+            self.assertEqual('Created splunk user client1.', self.getOutput())
+            self.assertEqual('client1 %s\n' % password, open(config['password_file']).read())
+            self.assertEqual(0600, os.stat(config['password_file']).st_mode & 0777)
+            self.assertEqual(None, ds.addUser({ 'client': 'client1' }))
+        finally:
+            shutil.rmtree(folder)
+
+    def testShouldProvisionBatchOfUsersListingUsersOnce(self):
+        self.splunkd.users['wigywigy'] = ['user']
+        self.splunkd.roles.extend(['client-wigywigy', 'client-client1', 'client-client2'])
+        ds = DeploySplunk(config=self.getConfig(self.splunkd.url), out=self.out, user='admin', password='changeme')
+        created = ds.addUsers([ { 'client': 'wigywigy' }, { 'client': 'client1' }, { 'client': 'client2' } ])
+        self.assertEqual(['client1', 'client2'], sorted(created.keys()))
+        self.assertEqual(['client-client1'], self.splunkd.users['client1'])
+        self.assertEqual(['client-wigywigy', 'user'], self.splunkd.users['wigywigy'])
+        self.assertEqual(1, self.splunkd.requests.count(('GET', '/services/authentication/users')))
+        self.assertEqual('', self.getOutput())
@@ -0,0 +1,66 @@
+import hashlib
+import os
+import threading
+from jinja2 import Environment, FileSystemBytecodeCache
+
+__author__ = 'jakub.zygmunt'
+
+class TemplateEngine(object):
+    """
+    shared jinja2 environment, compiles every template once per source hash
+    (the same app skeleton cloned for many clients is compiled once) and keeps
+    the compiled bytecode on disk for the next run
+    """
+
+    def __init__(self, cache_dir=None):
+        self.environment = Environment(bytecode_cache=FileSystemBytecodeCache(cache_dir))
+        self._templates = {}
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def _compile(self, key, source):
+        env = self.environment
+        bcc = env.bytecode_cache
+        bucket = bcc.get_bucket(env, key, None, source)
+        if bucket.code is None:
+            bucket.code = env.compile(source)
+            bcc.set_bucket(bucket)
+        return env.template_class.from_code(env, bucket.code, env.make_globals(None))
+
+    def fromSource(self, source):
+        key = hashlib.sha1(source).hexdigest()
+        with self._lock:
+            template = self._templates.get(key)
+        if template is None:
+            template = self._compile(key, source)
+            with self._lock:
+                self._templates[key] = template
+        return template
+
+    def readSource(self, filename):
+        """
+        returns the template source, read again only when the file has changed
+        """
+        stat = os.stat(filename)
+        version = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            cached = self._sources.get(filename)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with open(filename, 'r') as fr:
+            source = fr.read()
+        with self._lock:
+            self._sources[filename] = (version, source)
+        return source
+
+    def load(self, filename):
+        return self.fromSource(self.readSource(filename))
+
+    def render(self, filename, data):
+        return self.load(filename).render(data)
+
+    def stream(self, filename, data):
+        """
+        generator of the rendered output in chunks, so large outputs are never held in memory whole
+        """
+        return self.load(filename).generate(data)
@@ -0,0 +1,151 @@
+'''
+A very dummy imitation of the Cirrus CMDB json api
+serves collections (customers, aws_accounts, aws_instances...) from a dictionary,
+understands q[field_equals], q[field_in][], q[field_contains], q[field_gteq] filters and page
+latency, http 500s and timeouts can be injected, synthetic_collections builds customer datasets
+'''
+
+__author__ = 'jakub.zygmunt'
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import re
+import threading
+import time
+import urlparse
+
+filter_re = re.compile(r'^q\[(\w+?)_(equals|in|contains|gteq)\](\[\])?$')
+
+
+class CmdbStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status, content = self.server.stub.handle(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_HEAD(self):
+        status, content = self.server.stub.handle(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def synthetic_collections(customers=1, accounts=1, instances=10, security_groups=5, rules=2):
+    '''
+    every customer gets accounts aws accounts, the first account gets the instances,
+    security groups and rules (per group), half of the rules are open to 0.0.0.0
+    '''
+    collections = { 'customers': [], 'aws_accounts': [], 'aws_instances': [],
+                    'aws_security_groups': [], 'aws_security_group_rules': [] }
+    for c in range(1, customers + 1):
+        collections['customers'].append({ 'id': c, 'name': 'Customer %s' % c })
+        for a in range(1, accounts + 1):
+            account_id = (c - 1) * accounts + a
+            collections['aws_accounts'].append({ 'id': account_id, 'customer_id': c,
+                'number': '%012d' % account_id, 'name': 'account %s' % account_id,
+                'access_key_id': 'AKIA%08d' % account_id, 'secret_key': 'secret%s' % account_id })
+    for i in range(1, instances + 1):
+        collections['aws_instances'].append({ 'id': i, 'aws_account_id': 1, 'instance_id': 'i-%08x' % i,
+            'region': 'eu-west-1', 'reviewed_at': None, 'reviewed_sizing_at': None })
+    for g in range(1, security_groups + 1):
+        collections['aws_security_groups'].append({ 'id': g, 'aws_account_id': 1, 'name': 'sg-%s' % g,
+            'description': 'group %s' % g, 'region': 'eu-west-1', 'reviewed_at': None })
+        for r in range(rules):
+            collections['aws_security_group_rules'].append({ 'id': len(collections['aws_security_group_rules']) + 1,
+                'security_group_id': g, 'port': 22 + r, 'ip_range': '0.0.0.0/0' if r % 2 == 0 else '10.0.0.0/8' })
+    return collections
+
+
+class CmdbStub(object):
+
+    def __init__(self, collections=None, per_page=25, latency=0, error_rate=0, timeout_rate=0, timeout_delay=10):
+        self.collections = collections or {}
+        self.per_page = per_page
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.requests = []
+        self.failures = 0
+        self.random = random.Random(0)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), CmdbStubHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def requestsFor(self, collection):
+        return [r for r in self.requests if r.startswith('/%s.json' % collection)]
+
+    def matches(self, row, filters):
+        for field, operator, value in filters:
+            field_value = '%s' % row.get(field)
+            if operator == 'equals' and field_value != value:
+                return False
+            if operator == 'in' and field_value not in value:
+                return False
+            if operator == 'contains' and value not in field_value:
+                return False
+            if operator == 'gteq' and (row.get(field) is None or field_value < value):
+                return False
+        return True
+
+    def failNext(self, count):
+        """
+        the next count requests get http 500
+        """
+        self.failures = count
+
+    def handle(self, path):
+        self.requests.append(path)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            time.sleep(self.timeout_delay)
+        if self.failures > 0 or (self.error_rate and self.random.random() < self.error_rate):
+            self.failures = max(self.failures - 1, 0)
+            return 500, 'Internal Server Error'
+        url = urlparse.urlparse(path)
+        if url.path in ('', '/'):
+            return 200, '{}'
+        collection = url.path.strip('/').replace('.json', '')
+        if collection not in self.collections:
+            return 404, '[]'
+
+        page = 1
+        filters = []
+        in_values = {}
+        for key, value in urlparse.parse_qsl(url.query):
+            match = filter_re.match(key)
+            if key == 'page':
+                page = int(value)
+            elif match and match.group(2) == 'in':
+                in_values.setdefault(match.group(1), []).append(value)
+            elif match:
+                filters.append((match.group(1), match.group(2), value))
+        filters.extend((field, 'in', values) for field, values in in_values.items())
+
+        rows = [row for row in self.collections[collection] if self.matches(row, filters)]
+        return 200, json.dumps(rows[(page - 1) * self.per_page:page * self.per_page])
@@ -0,0 +1,121 @@
+'''
+A very dummy imitation of the splunkd management REST api
+admin:changeme - valid credentials, anything else is rejected
+keeps users, roles and apps in memory and records reloads and restarts
+users with roles it doesn't know are rejected, with authorize_conf set reloading
+authorization/roles loads the role_ stanzas of that file
+'''
+
+__author__ = 'jakub.zygmunt'
+import BaseHTTPServer
+import SocketServer
+import json
+import re
+import threading
+import urlparse
+
+
+class SplunkdStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(None)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.respond(self.rfile.read(length))
+
+    def respond(self, body):
+        status, content = self.server.stub.handle(self.command, self.path, body,
+            self.headers.getheader('Authorization'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # keep-alive connections of clients still alive when the stub stops mustn't block the shutdown
+    daemon_threads = True
+
+
+class SplunkdStub(object):
+    session_key = 'stub-session-key'
+
+    def __init__(self):
+        self.users = { 'admin': ['admin'] }
+        self.roles = ['admin', 'power', 'user']
+        self.authorize_conf = None
+        self.apps = ['search']
+        self.logins = 0
+        self.requests = []
+        self.reloads = []
+        self.restarts = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SplunkdStubHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:%s' % self.server.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def loadRoles(self):
+        for line in open(self.authorize_conf):
+            match = re.match(r'^\[role_(.+)\]\s*$', line)
+            if match is not None and match.group(1) not in self.roles:
+                self.roles.append(match.group(1))
+
+    def entries(self, names, content=None):
+        return json.dumps({ 'entry': [ { 'name': n, 'content': (content or {}).get(n, {}) } for n in names ] })
+
+    def handle(self, method, path, body, authorization):
+        url = urlparse.urlparse(path)
+        params = urlparse.parse_qs(body or url.query)
+        self.requests.append((method, url.path))
+
+        if url.path == '/services/auth/login':
+            if params.get('username') == ['admin'] and params.get('password') == ['changeme']:
+                self.logins += 1
+                return 200, json.dumps({ 'sessionKey': self.session_key })
+            return 401, json.dumps({ 'messages': [ { 'type': 'WARN', 'text': 'Login failed' } ] })
+
+        if authorization != 'Splunk %s' % self.session_key:
+            return 401, json.dumps({ 'messages': [ { 'type': 'WARN', 'text': 'Unauthorized' } ] })
+
+        if url.path.endswith('/_reload'):
+            self.reloads.append(url.path[len('/services/'):-len('/_reload')])
+            if url.path == '/services/authorization/roles/_reload' and self.authorize_conf is not None:
+                self.loadRoles()
+            return 200, '{}'
+        if url.path == '/services/server/control/restart':
+            self.restarts += 1
+            return 200, '{}'
+        unknown_roles = [r for r in params.get('roles', []) if r not in self.roles]
+        if method == 'POST' and url.path.startswith('/services/authentication/users') and unknown_roles:
+            return 400, json.dumps({ 'messages': [ { 'type': 'ERROR', 'text': "In handler 'users': "
+                                                     'Could not find role=%s' % unknown_roles[0] } ] })
+        if url.path == '/services/authentication/users':
+            if method == 'POST':
+                self.users[params['name'][0]] = params.get('roles', [])
+            return 200, self.entries(sorted(self.users), dict((u, { 'roles': r }) for u, r in self.users.items()))
+        if url.path.startswith('/services/authentication/users/'):
+            name = url.path.rsplit('/', 1)[1]
+            if name not in self.users:
+                return 404, '{}'
+            self.users[name] = params.get('roles', [])
+            return 200, self.entries([name], { name: { 'roles': self.users[name] } })
+        if url.path == '/services/authorization/roles':
+            return 200, self.entries(self.roles)
+        if url.path == '/services/apps/local':
+            return 200, self.entries(self.apps)
+        return 404, '{}'
@@ -3,6 +3,10 @@ A very dummy imitation of /opt/splunk/bin/splunk
 nouser:nouser - should return list without user wigywigy
 user:nopassword - invalid password
 user:user - valid password user exists
+down:down - splunkd isn't running
+add user / edit user - print the confirmation splunk prints, user broken fails like a rejected role
+_internal call - print the status splunk prints for an endpoint call, 404 for endpoints with missing in them
+restart - prints what splunk prints
 '''
 
 __author__ = 'jakub.zygmunt'
@@ -21,6 +25,10 @@ class SplunkDummy(object):
 Login failed
 Unauthorized'''
 
+    def down_down(self):
+        print "Couldn't complete HTTP request: Connection refused"
+        sys.exit(22)
+
     def display_users(self, user_list):
         output = []
         for username in user_list:
@@ -37,4 +45,16 @@ if args[0] == 'list':
         methodToCall()
     else :
         print "Function not found. (%s)" % function_name
+elif args[0] in ('add', 'edit') and args[1] == 'user' and args[2] == 'broken':
+    print "In handler 'users': Could not find role=%s" % args[args.index('-role') + 1]
+    sys.exit(22)
+elif args[0] == 'add' and args[1] == 'user':
+    print 'User added.'
+elif args[0] == 'edit' and args[1] == 'user':
+    print 'User edited.'
+elif args[0] == '_internal' and args[1] == 'call':
+    status = '404 (Not Found)' if 'missing' in args[2] else '200 (OK)'
+    print 'QUERYING: \'https://127.0.0.1:8089%s\'\nHTTPStatus: %s' % (args[2], status)
+elif args[0] == 'restart':
+    print 'Stopping splunkd...\nStarting splunk server daemon (splunkd)...\nDone'
 
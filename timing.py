@@ -0,0 +1,121 @@
+import cProfile
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+__author__ = 'jakub.zygmunt'
+
+class Span(object):
+    """
+    timed stage of a run with counters (bytes, pages, retries...) and other attributes
+    """
+
+    def __init__(self, name, start, **attrs):
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.thread = threading.current_thread().name
+        self.attrs = attrs
+        self.counts = {}
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def toDict(self):
+        record = { 'name': self.name, 'start': self.start, 'duration': self.duration, 'thread': self.thread }
+        record.update(self.attrs)
+        record.update(self.counts)
+        return record
+
+
+class Tracer(object):
+    """
+    collects spans from all threads, summarises them per stage and exports them as json lines,
+    spans are only kept between start and stop so long running processes don't pile them up
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        if self.enabled:
+            with self._lock:
+                self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        span = Span(name, time.time(), **attrs)
+        try:
+            yield span
+        finally:
+            span.duration = time.time() - span.start
+            self.record(span)
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+
+    def start(self):
+        """
+        drops the spans of a previous run and starts recording
+        """
+        self.reset()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def summary(self):
+        """
+        dictionary of stage name to calls, total/mean/max seconds and summed counters
+        """
+        stages = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            stage = stages.setdefault(span.name, { 'calls': 0, 'total': 0.0, 'max': 0.0 })
+            stage['calls'] += 1
+            stage['total'] += span.duration
+            stage['max'] = max(stage['max'], span.duration)
+            for key, value in span.counts.items():
+                stage[key] = stage.get(key, 0) + value
+        for stage in stages.values():
+            stage['mean'] = stage['total'] / stage['calls']
+        return stages
+
+    def report(self):
+        lines = ['%-24s %6s %10s %10s %10s  %s' % ('stage', 'calls', 'total', 'mean', 'max', 'counts')]
+        for name, stage in sorted(self.summary().items(), key=lambda s: -s[1]['total']):
+            counts = ' '.join('%s=%s' % (k, v) for k, v in sorted(stage.items())
+                              if k not in ('calls', 'total', 'mean', 'max'))
+            lines.append('%-24s %6d %9.3fs %9.3fs %9.3fs  %s' % (name, stage['calls'], stage['total'],
+                stage['mean'], stage['max'], counts))
+        return '\n'.join(lines) + '\n'
+
+    def exportJsonLines(self, filename):
+        with self._lock:
+            spans = list(self.spans)
+        with open(filename, 'w') as f:
+            for span in spans:
+                f.write(json.dumps(span.toDict(), default=str) + '\n')
+
+
+def profile(filename, func, *args, **kwargs):
+    """
+    runs func under cProfile, dumps the stats to filename (readable with pstats) and returns func's result
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(filename)
+
+
+tracer = Tracer()